@@ -0,0 +1,100 @@
+"""
+Awaitable wrappers around database.py for use inside aiogram handlers
+
+Every call is queued to a single worker thread, so SQLite I/O never blocks the
+event loop and queries still reach the shared connection one at a time.
+User registrations arriving within REGISTRATION_BATCH_DELAY of each other are
+written together in one transaction.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+
+# Seconds to collect registrations before writing them
+REGISTRATION_BATCH_DELAY = 0.005
+
+_pending_users = []  # [(row, future)]
+_registration_task = None
+
+async def _run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+async def init_db():
+    return await _run(database.init_db)
+
+async def add_user(user_id, username=None, first_name=None, last_name=None, has_invited=0, full_name=None):
+    """Queue a user upsert and wait until its batch is committed"""
+    global _registration_task
+    future = asyncio.get_running_loop().create_future()
+    _pending_users.append(((user_id, username, first_name, last_name, has_invited, full_name), future))
+    if _registration_task is None:
+        _registration_task = asyncio.create_task(_flush_registrations())
+    await future
+
+async def _flush_registrations():
+    global _registration_task
+    await asyncio.sleep(REGISTRATION_BATCH_DELAY)
+    batch = _pending_users[:]
+    _pending_users.clear()
+    _registration_task = None
+    try:
+        await _run(database.add_users, [row for row, _ in batch])
+    finally:
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+async def get_user(user_id):
+    return await _run(database.get_user, user_id)
+
+async def get_user_profile(user_id):
+    return await _run(database.get_user_profile, user_id)
+
+async def get_user_profiles():
+    return await _run(database.get_user_profiles)
+
+async def get_user_language(user_id):
+    return await _run(database.get_user_language, user_id)
+
+async def set_user_language(user_id, lang):
+    return await _run(database.set_user_language, user_id, lang)
+
+async def count_users():
+    return await _run(database.count_users)
+
+async def add_test_result(user_id, result):
+    return await _run(database.add_test_result, user_id, result)
+
+async def get_test_results(user_id):
+    return await _run(database.get_test_results, user_id)
+
+async def get_all_users():
+    return await _run(database.get_all_users)
+
+async def remove_user(user_id):
+    return await _run(database.remove_user, user_id)
+
+async def add_referral(referrer_id, referred_id):
+    return await _run(database.add_referral, referrer_id, referred_id)
+
+async def has_invited_friend(user_id):
+    # Answered in place once the invite gate is warm, no thread hop needed
+    status = database.invite_gate.status(user_id)
+    if status is not None:
+        return status
+    return await _run(database.has_invited_friend, user_id)
+
+async def get_referrer(user_id):
+    return await _run(database.get_referrer, user_id)
+
+async def close_db():
+    """Wait for queued queries, then close the shared connection"""
+    if _registration_task is not None:
+        await _registration_task
+    await _run(database.close_db)
+    _executor.shutdown(wait=True)
@@ -0,0 +1,147 @@
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+class LRUCache:
+    """
+    Least-recently-used cache bounded by entry count and/or an estimated memory budget
+    sizeof: function returning the approximate size of a value in bytes
+    """
+    def __init__(self, max_items: Optional[int] = None, max_bytes: Optional[int] = None,
+                 sizeof: Optional[Callable[[Any], int]] = None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (value, size)
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return a cached value and mark it as recently used"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return entry[0]
+    
+    def put(self, key: Hashable, value: Any) -> None:
+        """Store a value, evicting the least recently used entries if over budget"""
+        self.pop(key)
+        size = self.sizeof(value)
+        self._data[key] = (value, size)
+        self.total_bytes += size
+        self._evict()
+    
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove a value from the cache"""
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self.total_bytes -= entry[1]
+        return entry[0]
+    
+    def clear(self) -> None:
+        self._data.clear()
+        self.total_bytes = 0
+    
+    def _evict(self) -> None:
+        # Always keep the newest entry, even if it alone is over budget
+        while len(self._data) > 1 and (
+            (self.max_items is not None and len(self._data) > self.max_items) or
+            (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            _, (_, size) = self._data.popitem(last=False)
+            self.total_bytes -= size
+
+class IntByteMap:
+    """
+    Compact map from integer keys (e.g. Telegram user ids) to small values 0..254
+    Open addressing with linear probing over a signed 64-bit key array and a byte
+    array, about 12-24 bytes per entry instead of a few hundred for a dict of dicts
+    """
+    _EMPTY = 255
+    
+    def __init__(self, capacity: int = 1024):
+        size = 8
+        while size < capacity:
+            size *= 2
+        self._alloc(size)
+        self._count = 0
+    
+    def _alloc(self, size: int) -> None:
+        self._mask = size - 1
+        self._keys = array('q', bytes(8 * size))
+        self._values = bytearray([self._EMPTY]) * size
+    
+    def __len__(self) -> int:
+        return self._count
+    
+    def __contains__(self, key: int) -> bool:
+        return self.get(key) is not None
+    
+    def _slot(self, key: int) -> int:
+        """Slot holding key, or the empty slot where it would go"""
+        mask = self._mask
+        keys = self._keys
+        values = self._values
+        i = (key * 0x9E3779B1) & mask
+        while values[i] != self._EMPTY and keys[i] != key:
+            i = (i + 1) & mask
+        return i
+    
+    def get(self, key: int, default: Optional[int] = None) -> Optional[int]:
+        value = self._values[self._slot(key)]
+        return default if value == self._EMPTY else value
+    
+    def put(self, key: int, value: int) -> None:
+        if not 0 <= value < self._EMPTY:
+            raise ValueError(f"Value must be in 0..{self._EMPTY - 1}")
+        i = self._slot(key)
+        if self._values[i] == self._EMPTY:
+            # Keep the load factor under 3/4
+            if (self._count + 1) * 4 > len(self._values) * 3:
+                self._grow()
+                i = self._slot(key)
+            self._keys[i] = key
+            self._count += 1
+        self._values[i] = value
+    
+    def pop(self, key: int, default: Optional[int] = None) -> Optional[int]:
+        i = self._slot(key)
+        value = self._values[i]
+        if value == self._EMPTY:
+            return default
+        self._values[i] = self._EMPTY
+        self._count -= 1
+        # Shift later entries of the probe chain back so lookups don't stop at the hole
+        mask = self._mask
+        j = i
+        while True:
+            j = (j + 1) & mask
+            if self._values[j] == self._EMPTY:
+                break
+            home = (self._keys[j] * 0x9E3779B1) & mask
+            if (j - home) & mask >= (j - i) & mask:
+                self._keys[i] = self._keys[j]
+                self._values[i] = self._values[j]
+                self._values[j] = self._EMPTY
+                i = j
+        return value
+    
+    def _grow(self) -> None:
+        keys, values = self._keys, self._values
+        self._alloc(len(values) * 2)
+        for key, value in zip(keys, values):
+            if value != self._EMPTY:
+                i = self._slot(key)
+                self._keys[i] = key
+                self._values[i] = value
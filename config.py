@@ -8,6 +8,49 @@ ADMINS = [int(admin_id) for admin_id in os.environ.get("ADMIN_IDS", "123456789")
 
 # Database filename
 DATABASE_FILE = "bot_users.db"
+# Number of user profiles kept in memory
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+
+# Test storage backend: "json" (user_tests.json) or "sqlite" (user_tests.db)
+TEST_STORAGE_BACKEND = os.environ.get("TEST_STORAGE_BACKEND", "json")
+TEST_STORAGE_DB = "user_tests.db"
+# Memory budget for lazily loaded per-user test lists (sqlite backend)
+TEST_STORAGE_CACHE_MB = int(os.environ.get("TEST_STORAGE_CACHE_MB", "32"))
+
+# Test storage file; journal mode appends changes instead of rewriting the file
+TEST_STORAGE_PATH = "user_tests.json"
+TEST_STORAGE_JOURNAL = os.environ.get("TEST_STORAGE_JOURNAL", "1") == "1"
+TEST_STORAGE_COMPACT_THRESHOLD = int(os.environ.get("TEST_STORAGE_COMPACT_THRESHOLD", "200"))
+# Number of previous snapshots kept as user_tests.json.1 ... .N
+TEST_STORAGE_GENERATIONS = int(os.environ.get("TEST_STORAGE_GENERATIONS", "3"))
+# Snapshot format: "json" or "binary" (smaller and faster; the website only reads json).
+# Switching converts the existing file on the next save
+TEST_STORAGE_FORMAT = os.environ.get("TEST_STORAGE_FORMAT", "json")
+# Write-behind mode queues changes and writes them in batches every few seconds
+TEST_STORAGE_WRITE_BEHIND = os.environ.get("TEST_STORAGE_WRITE_BEHIND", "1") == "1"
+TEST_STORAGE_FLUSH_INTERVAL = float(os.environ.get("TEST_STORAGE_FLUSH_INTERVAL", "2.0"))
+
+# FSM storage: "sqlite" keeps quiz progress across restarts, "memory" is aiogram's default
+FSM_STORAGE = os.environ.get("FSM_STORAGE", "sqlite")
+FSM_STORAGE_DB = "fsm_storage.db"
+FSM_FLUSH_INTERVAL = float(os.environ.get("FSM_FLUSH_INTERVAL", "1.0"))
+
+# Telegram requests per quiz question:
+# 1 - poll only, the counter is part of the poll question and the /stop hint is sent once
+# 2 - "Question N/M" message and poll, the /stop hint is sent once
+# 3 - /stop hint, "Question N/M" message and poll for every question (old behaviour)
+QUIZ_MESSAGES_PER_QUESTION = int(os.environ.get("QUIZ_MESSAGES_PER_QUESTION", "1"))
+
+# Quiz time limits in seconds, 0 turns a limit off
+# Time to answer one question (the poll's open_period, 5-600); unanswered questions count as wrong
+QUIZ_QUESTION_TIME = int(os.environ.get("QUIZ_QUESTION_TIME", "0"))
+if QUIZ_QUESTION_TIME and not 5 <= QUIZ_QUESTION_TIME <= 600:
+    # Telegram would reject every quiz poll
+    raise ValueError(f"QUIZ_QUESTION_TIME must be 0 or 5-600 seconds, got {QUIZ_QUESTION_TIME}")
+# Time for the whole quiz, the results are sent when it runs out
+QUIZ_TIME_LIMIT = int(os.environ.get("QUIZ_TIME_LIMIT", "0"))
+# A quiz without answers for this long is abandoned and its session freed
+QUIZ_IDLE_TIMEOUT = int(os.environ.get("QUIZ_IDLE_TIMEOUT", "3600"))
 
 # Path to manual video
 MANUAL_VIDEO_PATH = "manual.mp4"
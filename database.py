@@ -1,168 +1,353 @@
 import sqlite3
 import logging
+import threading
+from contextlib import contextmanager
 from config import DATABASE_FILE
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ConnectionManager:
+    """
+    One long-lived SQLite connection shared by all database functions
+    The connection is opened on first use, tuned once and guarded by a lock, so it
+    can be used from the event loop as well as from worker threads
+    Statements are kept compiled in the connection's statement cache
+    """
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",   # durable enough with WAL, no fsync per commit
+        "PRAGMA busy_timeout=5000",    # the website reads the same file
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",     # ~8 MB page cache
+    )
+    
+    def __init__(self, db_path, cached_statements=256):
+        self.db_path = db_path
+        self.cached_statements = cached_statements
+        self._conn = None
+        self._lock = threading.RLock()
+    
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    @contextmanager
+    def cursor(self):
+        """Lock the connection and yield a cursor for reads"""
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            cursor = self._conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+    
+    @contextmanager
+    def transaction(self):
+        """Like cursor(), but commits on success and rolls back on error"""
+        with self.cursor() as cursor:
+            try:
+                yield cursor
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+db = ConnectionManager(DATABASE_FILE)
+
+# Bumped whenever init_db learns a new migration (stored in PRAGMA user_version)
+SCHEMA_VERSION = 3
+
+class InviteGate:
+    """
+    Process-local set of users who have invited a friend
+    Invite status only ever goes from False to True, so once the set is warmed from
+    the database it answers has_invited_friend on its own
+    """
+    def __init__(self):
+        self.unlocked = set()
+        self.warm = False
+    
+    def load(self, cursor):
+        cursor.execute('''
+        SELECT user_id FROM users WHERE has_invited_friend = 1
+        UNION SELECT referrer_id FROM referrals
+        ''')
+        self.unlocked = {row[0] for row in cursor.fetchall()}
+        self.warm = True
+    
+    def status(self, user_id):
+        """True/False when known without a query, None if the database must be asked"""
+        if user_id in self.unlocked:
+            return True
+        return False if self.warm else None
+    
+    def unlock(self, user_id):
+        self.unlocked.add(user_id)
+
+invite_gate = InviteGate()
+
+def close_db():
+    """Close the shared connection (called on shutdown)"""
+    db.close()
+
 def init_db():
     """Initialize the database if it doesn't exist."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    # Create users table if it doesn't exist
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        has_invited_friend INTEGER DEFAULT 0
-    )
-    ''')
+    with db.transaction() as cursor:
+        # Create users table if it doesn't exist
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            has_invited_friend INTEGER DEFAULT 0
+        )
+        ''')
+        
+        # Create referrals table to track invitations
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS referrals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER,
+            referred_id INTEGER,
+            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (referrer_id) REFERENCES users(user_id),
+            FOREIGN KEY (referred_id) REFERENCES users(user_id)
+        )
+        ''')
+        
+        # Quiz results shown under "My results"
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS test_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            test_name TEXT,
+            date TEXT,
+            correct INTEGER,
+            total INTEGER,
+            percent REAL,
+            points REAL
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_test_results_user ON test_results (user_id, id)')
+        
+        cursor.execute('PRAGMA user_version')
+        version = cursor.fetchone()[0]
+        if version < 1:
+            _migrate_referral_indexes(cursor)
+        if version < 2:
+            cursor.execute('ALTER TABLE users ADD COLUMN full_name TEXT')
+        if version < 3:
+            cursor.execute('ALTER TABLE users ADD COLUMN language TEXT')
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        
+        invite_gate.load(cursor)
     
-    # Create referrals table to track invitations
+    logger.info(f"Database initialized successfully, {len(invite_gate.unlocked)} users unlocked")
+
+def _migrate_referral_indexes(cursor):
+    """Index referrals by both sides and allow only one referrer per user"""
+    # Older versions could record the same user twice, keep the first referral
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS referrals (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        referrer_id INTEGER,
-        referred_id INTEGER,
-        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (referrer_id) REFERENCES users(user_id),
-        FOREIGN KEY (referred_id) REFERENCES users(user_id)
-    )
+    DELETE FROM referrals
+    WHERE id NOT IN (SELECT MIN(id) FROM referrals GROUP BY referred_id)
     ''')
-    
-    conn.commit()
-    conn.close()
-    logger.info("Database initialized successfully")
+    if cursor.rowcount > 0:
+        logger.info(f"Removed {cursor.rowcount} duplicate referrals")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id)')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_referrals_referred ON referrals (referred_id)')
+
+_UPSERT_USER = '''
+INSERT INTO users (user_id, username, first_name, last_name, has_invited_friend, full_name)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (user_id) DO UPDATE SET
+    username = excluded.username,
+    first_name = excluded.first_name,
+    last_name = excluded.last_name,
+    has_invited_friend = MAX(has_invited_friend, excluded.has_invited_friend),
+    full_name = COALESCE(excluded.full_name, full_name)
+'''
 
-def add_user(user_id, username=None, first_name=None, last_name=None, has_invited=0):
+def add_user(user_id, username=None, first_name=None, last_name=None, has_invited=0, full_name=None):
     """Add a new user to the database or update existing user."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
+    add_users([(user_id, username, first_name, last_name, has_invited, full_name)])
+
+def add_users(rows):
+    """
+    Add or update several users in one transaction
+    rows: (user_id, username, first_name, last_name, has_invited, full_name) tuples
+    has_invited_friend is only ever raised, an existing user never loses it
+    """
     try:
-        # Check if user already exists
-        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        existing_user = cursor.fetchone()
+        with db.transaction() as cursor:
+            cursor.executemany(_UPSERT_USER, rows)
         
-        if existing_user:
-            # Update existing user but don't change has_invited_friend status
-            cursor.execute('''
-            UPDATE users 
-            SET username = ?, first_name = ?, last_name = ?
-            WHERE user_id = ?
-            ''', (username, first_name, last_name, user_id))
+        for user_id, _, _, _, has_invited, _ in rows:
+            if has_invited:
+                invite_gate.unlock(user_id)
+        if len(rows) == 1:
+            logger.info(f"User {rows[0][0]} added/updated in database")
         else:
-            # Insert new user with has_invited_friend status
-            cursor.execute('''
-            INSERT INTO users (user_id, username, first_name, last_name, has_invited_friend)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name, has_invited))
-        
-        conn.commit()
-        logger.info(f"User {user_id} added/updated in database")
+            logger.info(f"{len(rows)} users added/updated in database")
     except Exception as e:
         logger.error(f"Error adding user to database: {e}")
-    finally:
-        conn.close()
 
 def get_user(user_id):
     """Get user information from the database."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    
-    conn.close()
-    return user
+    with db.cursor() as cursor:
+        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        return cursor.fetchone()
+
+def get_user_profile(user_id):
+    """Get a user's name and join date as a dict, or None for unknown users."""
+    with db.cursor() as cursor:
+        cursor.execute(
+            'SELECT username, full_name, first_name, join_date FROM users WHERE user_id = ?', (user_id,)
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    username, full_name, first_name, join_date = row
+    return {"username": username, "full_name": full_name or first_name or "", "joined_date": join_date}
+
+def get_user_profiles():
+    """Get (user_id, profile) pairs for every user, see get_user_profile, plus their language."""
+    with db.cursor() as cursor:
+        cursor.execute(
+            'SELECT user_id, username, full_name, first_name, join_date, language FROM users ORDER BY join_date'
+        )
+        return [
+            (user_id, {
+                "username": username,
+                "full_name": full_name or first_name or "",
+                "joined_date": join_date,
+                "language": language
+            })
+            for user_id, username, full_name, first_name, join_date, language in cursor.fetchall()
+        ]
+
+def get_user_language(user_id):
+    """Get the user's chosen language code, or None if they never picked one."""
+    with db.cursor() as cursor:
+        cursor.execute('SELECT language FROM users WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def set_user_language(user_id, lang):
+    """Remember the user's language choice."""
+    with db.transaction() as cursor:
+        cursor.execute('UPDATE users SET language = ? WHERE user_id = ?', (lang, user_id))
+
+def count_users():
+    """Count registered users."""
+    with db.cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM users')
+        return cursor.fetchone()[0]
+
+def add_test_result(user_id, result):
+    """Store a finished quiz result (dict with test_name, date, correct, total, percent, points)."""
+    with db.transaction() as cursor:
+        cursor.execute('''
+        INSERT INTO test_results (user_id, test_name, date, correct, total, percent, points)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            user_id, result["test_name"], result["date"], result["correct"],
+            result["total"], result["percent"], result["points"]
+        ))
+
+def get_test_results(user_id):
+    """Get a user's quiz results, oldest first."""
+    with db.cursor() as cursor:
+        cursor.execute('''
+        SELECT test_name, date, correct, total, percent, points
+        FROM test_results WHERE user_id = ? ORDER BY id
+        ''', (user_id,))
+        return [
+            {"test_name": test_name, "date": date, "correct": correct, "total": total, "percent": percent, "points": points}
+            for test_name, date, correct, total, percent, points in cursor.fetchall()
+        ]
 
 def get_all_users():
     """Get all users from the database."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT user_id FROM users')
-    users = [row[0] for row in cursor.fetchall()]
-    
-    conn.close()
-    return users
+    with db.cursor() as cursor:
+        cursor.execute('SELECT user_id FROM users')
+        return [row[0] for row in cursor.fetchall()]
 
 def remove_user(user_id):
     """Remove a user from the database."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
     
-    cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-    
-    conn.commit()
-    conn.close()
     logger.info(f"User {user_id} removed from database")
 
 def add_referral(referrer_id, referred_id):
     """Add a new referral record."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
     try:
-        # Add the referral record
-        cursor.execute('''
-        INSERT INTO referrals (referrer_id, referred_id)
-        VALUES (?, ?)
-        ''', (referrer_id, referred_id))
-        
-        # Update referrer's has_invited_friend status
-        cursor.execute('''
-        UPDATE users
-        SET has_invited_friend = 1
-        WHERE user_id = ?
-        ''', (referrer_id,))
+        with db.transaction() as cursor:
+            # Add the referral record, a user can only be referred once
+            cursor.execute('''
+            INSERT OR IGNORE INTO referrals (referrer_id, referred_id)
+            VALUES (?, ?)
+            ''', (referrer_id, referred_id))
+            if cursor.rowcount == 0:
+                logger.info(f"User {referred_id} already has a referrer")
+                return False
+            
+            # Update referrer's has_invited_friend status
+            cursor.execute('''
+            UPDATE users
+            SET has_invited_friend = 1
+            WHERE user_id = ?
+            ''', (referrer_id,))
+        invite_gate.unlock(referrer_id)
         
-        conn.commit()
         logger.info(f"User {referred_id} was referred by {referrer_id}")
         return True
     except Exception as e:
         logger.error(f"Error adding referral: {e}")
         return False
-    finally:
-        conn.close()
 
 def has_invited_friend(user_id):
     """Check if user has invited at least one friend."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    status = invite_gate.status(user_id)
+    if status is not None:
+        return status
     
-    # Check if user has the has_invited_friend flag set
-    cursor.execute('SELECT has_invited_friend FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    
-    # Also check the referrals table directly
-    cursor.execute('SELECT COUNT(*) FROM referrals WHERE referrer_id = ?', (user_id,))
-    referral_count = cursor.fetchone()[0]
-    
-    conn.close()
-    
-    # Return True if either condition is met
-    if result and result[0] == 1:
-        return True
-    if referral_count > 0:
-        return True
-    return False
+    with db.cursor() as cursor:
+        # Either the has_invited_friend flag is set or a referral exists,
+        # both answered from the primary key and the referrer index
+        cursor.execute('''
+        SELECT EXISTS (SELECT 1 FROM users WHERE user_id = ? AND has_invited_friend = 1)
+            OR EXISTS (SELECT 1 FROM referrals WHERE referrer_id = ?)
+        ''', (user_id, user_id))
+        invited = cursor.fetchone()[0] == 1
+    if invited:
+        invite_gate.unlock(user_id)
+    return invited
 
 def get_referrer(user_id):
     """Get the referrer of a user, if any."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT referrer_id FROM referrals WHERE referred_id = ?', (user_id,))
-    result = cursor.fetchone()
-    
-    conn.close()
+    with db.cursor() as cursor:
+        cursor.execute('SELECT referrer_id FROM referrals WHERE referred_id = ?', (user_id,))
+        result = cursor.fetchone()
     
     if result:
         return result[0]
-    return None
+    return None
\ No newline at end of file
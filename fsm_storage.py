@@ -0,0 +1,145 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage that survives restarts
+    States and data are served from an in-memory mirror loaded at startup; changes
+    are written to SQLite (WAL) in one transaction every `flush_interval` seconds
+    from a worker thread, so handlers never wait for disk
+    State data must be JSON serializable (tuples come back as lists)
+    """
+    def __init__(self, db_path: str = "fsm_storage.db", flush_interval: float = 1.0):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._records: Dict[str, Tuple[Optional[str], Dict[str, Any]]] = {}
+        self._dirty = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = threading.Lock()
+        
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL
+            ) WITHOUT ROWID
+            ''')
+        self._load()
+    
+    def _load(self) -> None:
+        for key, state, data in self.conn.execute('SELECT key, state, data FROM fsm'):
+            try:
+                self._records[key] = (state, json.loads(data))
+            except ValueError:
+                logging.warning(f"Skipping damaged FSM record {key}")
+        logging.info(f"Restored {len(self._records)} FSM records from {self.db_path}")
+    
+    def _get(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        return self._records.get(self._key_builder.build(key), (None, {}))
+    
+    def _put(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]) -> None:
+        record_key = self._key_builder.build(key)
+        if state is None and not data:
+            # Nothing left to remember; only write the delete if the key ever existed
+            if self._records.pop(record_key, None) is None:
+                return
+        else:
+            self._records[record_key] = (state, data)
+        self._dirty.add(record_key)
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        self._put(key, state, self._get(key)[1])
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._get(key)[0]
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._put(key, self._get(key)[0], data.copy())
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._get(key)[1].copy()
+    
+    def records_in_state(self, state: StateType) -> Iterator[Tuple[StorageKey, Dict[str, Any]]]:
+        """
+        (key, data) of every record in `state`, e.g. to resume work after a restart
+        Only plain chat/user keys are parsed back; records with a business
+        connection or thread id are skipped
+        """
+        state = state.state if isinstance(state, State) else state
+        for record_key, (record_state, data) in list(self._records.items()):
+            if record_state != state:
+                continue
+            parts = record_key.split(":")
+            if len(parts) != 5 or parts[0] != self._key_builder.prefix:
+                continue
+            _, bot_id, chat_id, user_id, destiny = parts
+            yield StorageKey(bot_id=int(bot_id), chat_id=int(chat_id), user_id=int(user_id), destiny=destiny), data.copy()
+    
+    def _take_dirty(self):
+        """Collect changed records, called on the event loop so handlers can't interleave"""
+        batch = [(record_key, self._records.get(record_key)) for record_key in self._dirty]
+        self._dirty = set()
+        return batch
+    
+    def _write(self, batch) -> None:
+        """Write a batch from _take_dirty() in one transaction (runs in a worker thread)"""
+        upserts = []
+        deletes = []
+        for record_key, record in batch:
+            if record is None:
+                deletes.append((record_key,))
+            else:
+                try:
+                    upserts.append((record_key, record[0], json.dumps(record[1], ensure_ascii=False)))
+                except TypeError as e:
+                    # Retrying won't help, the in-memory copy stays usable until restart
+                    logging.error(f"FSM record {record_key} is not JSON serializable: {e}")
+        with self._write_lock, self.conn:
+            self.conn.executemany('DELETE FROM fsm WHERE key = ?', deletes)
+            self.conn.executemany('INSERT OR REPLACE INTO fsm (key, state, data) VALUES (?, ?, ?)', upserts)
+    
+    async def flush(self) -> None:
+        """Write every changed record; failed records are retried with the next batch"""
+        batch = self._take_dirty()
+        if not batch:
+            return
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except Exception as e:
+            logging.error(f"Error saving FSM records: {e}")
+            self._dirty.update(record_key for record_key, _ in batch)
+    
+    def start_write_behind(self) -> None:
+        """Start the background flush task, must be called from the running event loop"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    
+    async def close(self) -> None:
+        """Stop the flush task, write out pending changes and close the database"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        self.conn.close()
@@ -1,6 +1,9 @@
 """
 Bot uchun tillar lokalizatsiyasi (O'zbek va Rus tillari)
 """
+from types import MappingProxyType
+
+from aiogram import types
 
 TEXTS = {
     'uz': {
@@ -155,6 +158,7 @@ Yangi format (.txt fayllar uchun):
         'btn_sequential_answers': "📝 Ketma-ket javoblar",
         'quiz_starting': "🎯 Test boshlanmoqda...",
         'question': "📝 Savol {current}/{total}:",
+        'poll_question': "[{current}/{total}] {question}",
         'quiz_finish_placeholder': "Test yakunlandi",
         'quiz_detailed_results': "<b>📊 Test natijalari:</b>\n\n<b>📝 Test: {name}</b>\n📆 Sana: {date}\n\n📚 <b>Natijalar:</b>\n✅ To'g'ri javoblar: <code>{correct}</code>\n❌ Noto'g'ri javoblar: <code>{wrong}</code>\n📊 Jami savollar: <code>{total}</code>\n\n📈 <b>Foiz:</b> <code>{percent}%</code>\n💯 <b>Ball:</b> <code>{points}</code>",
         'quiz_results_list_item': "<b>📝 {name}</b>\n📆 {date}\n📊 {percent}% ({correct}/{total})",
@@ -167,6 +171,10 @@ Yangi format (.txt fayllar uchun):
         'test_file_forwarded': "👤 Yuqoridagi fayl {name} (@{username}) tomonidan yuborildi",
         'stop_info': "❗️ Testni to'xtatish uchun /stop buyrug'ini yuboring.",
         'test_stopped': "🛑 Test to'xtatildi!\n\n",
+        'question_time_info': "⏱ Har bir savolga {seconds} soniya beriladi.",
+        'quiz_time_limit_info': "⏱ Test uchun {minutes} daqiqa vaqt beriladi.",
+        'quiz_time_up': "⏰ Test vaqti tugadi!",
+        'quiz_expired': "⌛️ Test uzoq vaqt javobsiz qolgani uchun yakunlandi.\n\n",
         'feedback_prompt': "💬 Iltimos, o'z fikr-mulohazalaringiz yoki takliflaringizni yuboring:",
         'feedback_sent': "✅ Fikr-mulohazangiz uchun rahmat! Xabaringiz adminga yuborildi.",
         'user_feedback': "💬 <b>Foydalanuvchi fikri:</b>\n{message}\n\n<b>Yuboruvchi:</b> {name} (@{username})",
@@ -347,6 +355,7 @@ Question 2.
         'btn_sequential_answers': "📝 Последовательные ответы",
         'quiz_starting': "🎯 Тест начинается...",
         'question': "📝 Вопрос {current}/{total}:",
+        'poll_question': "[{current}/{total}] {question}",
         'quiz_finish_placeholder': "Тест завершен",
         'quiz_detailed_results': "<b>📊 Результаты теста:</b>\n\n<b>📝 Тест: {name}</b>\n📆 Дата: {date}\n\n📚 <b>Результаты:</b>\n✅ Правильные ответы: <code>{correct}</code>\n❌ Неправильные ответы: <code>{wrong}</code>\n📊 Всего вопросов: <code>{total}</code>\n\n📈 <b>Процент:</b> <code>{percent}%</code>\n💯 <b>Баллы:</b> <code>{points}</code>",
         'quiz_results_list_item': "<b>📝 {name}</b>\n📆 {date}\n📊 {percent}% ({correct}/{total})",
@@ -359,6 +368,10 @@ Question 2.
         'test_file_forwarded': "👤 Вышеуказанный файл был отправлен пользователем {name} (@{username})",
         'stop_info': "❗️ Чтобы остановить тест, отправьте команду /stop.",
         'test_stopped': "🛑 Тест остановлен!\n\n",
+        'question_time_info': "⏱ На каждый вопрос даётся {seconds} секунд.",
+        'quiz_time_limit_info': "⏱ На тест даётся {minutes} минут.",
+        'quiz_time_up': "⏰ Время теста истекло!",
+        'quiz_expired': "⌛️ Тест завершён, так как долго не было ответов.\n\n",
         'feedback_prompt': "💬 Пожалуйста, отправьте свои отзывы или предложения:",
         'feedback_sent': "✅ Спасибо за ваш отзыв! Ваше сообщение было отправлено администратору.",
         'user_feedback': "💬 <b>Отзыв пользователя:</b>\n{message}\n\n<b>Отправитель:</b> {name} (@{username})",
@@ -389,9 +402,76 @@ Question 2.
     }
 }
 
+DEFAULT_LANGUAGE = 'uz'
+
+# Read-only catalogue per language, built once at import; missing keys fall back to Uzbek
+CATALOGUES = MappingProxyType({
+    lang: MappingProxyType({**TEXTS[DEFAULT_LANGUAGE], **texts})
+    for lang, texts in TEXTS.items()
+})
+
 def get_text(lang, key):
     """Berilgan til uchun matnni qaytaradi"""
-    if lang not in TEXTS:
-        lang = 'uz'  # Default til
-    
-    return TEXTS[lang].get(key, TEXTS['uz'].get(key, f"TEXT_{key}"))
\ No newline at end of file
+    catalogue = CATALOGUES.get(lang) or CATALOGUES[DEFAULT_LANGUAGE]
+    text = catalogue.get(key)
+    return text if text is not None else f"TEXT_{key}"
+
+def _reply_keyboard(texts, rows, placeholder=None):
+    return types.ReplyKeyboardMarkup(
+        keyboard=[[types.KeyboardButton(text=texts[key]) for key in row] for row in rows],
+        resize_keyboard=True,
+        input_field_placeholder=texts[placeholder] if placeholder else None
+    )
+
+def _inline_keyboard(texts, rows):
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=texts[key], callback_data=data) for key, data in row]
+        for row in rows
+    ])
+
+_MAIN_MENU_ROWS = [
+    ["btn_create_quiz", "btn_my_tests"],
+    ["btn_results", "btn_guide"],
+    ["btn_feedback", "btn_invite"]
+]
+
+def _build_keyboards(texts):
+    return MappingProxyType({
+        'main_menu': _reply_keyboard(texts, _MAIN_MENU_ROWS, 'menu_placeholder'),
+        'admin_menu': _reply_keyboard(
+            texts, _MAIN_MENU_ROWS + [["btn_admin_stats", "btn_broadcast"]], 'menu_placeholder'
+        ),
+        'back_to_menu': _reply_keyboard(texts, [["btn_main_menu"]]),
+        'quiz_finished': _reply_keyboard(texts, [["btn_main_menu"]], 'quiz_finish_placeholder'),
+        'question_order': _reply_keyboard(
+            texts, [["btn_shuffle_questions"], ["btn_sequential_questions"], ["btn_main_menu"]]
+        ),
+        'answer_order': _reply_keyboard(
+            texts, [["btn_shuffle_answers"], ["btn_sequential_answers"], ["btn_main_menu"]]
+        ),
+        'broadcast_type': _inline_keyboard(texts, [
+            [("broadcast_type_text", "broadcast_type:text")],
+            [("broadcast_type_photo", "broadcast_type:photo")],
+            [("broadcast_type_video", "broadcast_type:video")],
+            [("broadcast_type_poll", "broadcast_type:poll")]
+        ]),
+        'broadcast_confirm': _inline_keyboard(texts, [
+            [("broadcast_confirm_yes", "broadcast_confirm:yes"), ("broadcast_confirm_no", "broadcast_confirm:no")]
+        ])
+    })
+
+# Static keyboards per language, shared by every message: never modify them
+KEYBOARDS = MappingProxyType({lang: _build_keyboards(texts) for lang, texts in CATALOGUES.items()})
+
+LANGUAGE_KEYBOARD = types.InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            types.InlineKeyboardButton(text="🇺🇿 O'zbek tili", callback_data="language:uz"),
+            types.InlineKeyboardButton(text="🇷🇺 Русский язык", callback_data="language:ru")
+        ]
+    ]
+)
+
+def get_keyboard(lang, name):
+    """Pre-built keyboard for the given language"""
+    return (KEYBOARDS.get(lang) or KEYBOARDS[DEFAULT_LANGUAGE])[name]
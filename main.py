@@ -2,19 +2,37 @@ from aiogram import Bot, Dispatcher, types, F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import SendMessage, SendPoll
 from docx import Document
 import asyncio
+import inspect
 import os
 import json
 import logging
 import time
-import random
 from datetime import datetime
 
-from quiz_utils import convert_format, calculate_points, get_result_message, parse_text_file
+from quiz_utils import (
+    convert_format, calculate_points, get_result_message, parse_text_file,
+    make_question_order
+)
 from storage import TestStorage
-from localization import get_text
-from database import init_db
+from quiz_session import QuizSession, PollIndex
+from cache import LRUCache
+from metrics import metrics
+from scheduler import TimeoutScheduler
+from localization import get_text, get_keyboard, TEXTS, LANGUAGE_KEYBOARD
+from async_database import init_db, close_db
+from user_registry import UserRegistry
+from config import (
+    TEST_STORAGE_BACKEND, TEST_STORAGE_DB, TEST_STORAGE_CACHE_MB,
+    TEST_STORAGE_PATH, TEST_STORAGE_JOURNAL, TEST_STORAGE_COMPACT_THRESHOLD,
+    TEST_STORAGE_WRITE_BEHIND, TEST_STORAGE_FLUSH_INTERVAL, TEST_STORAGE_GENERATIONS,
+    TEST_STORAGE_FORMAT, USER_CACHE_SIZE, FSM_STORAGE, FSM_STORAGE_DB, FSM_FLUSH_INTERVAL,
+    QUIZ_MESSAGES_PER_QUESTION, QUIZ_QUESTION_TIME, QUIZ_TIME_LIMIT, QUIZ_IDLE_TIMEOUT
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -29,17 +47,32 @@ ADMIN_IDS = [1477944238]  # Admin ID larini kiriting
 # Add flag to track if user has seen the referral link
 USER_FIRST_JOIN = {}  # Store user_id -> True/False
 bot = Bot(token=TOKEN)
-dp = Dispatcher()
 
-# Initialize test storage
-test_storage = TestStorage()
+if FSM_STORAGE == "sqlite":
+    from fsm_storage import SQLiteStorage
+    fsm_storage = SQLiteStorage(FSM_STORAGE_DB, flush_interval=FSM_FLUSH_INTERVAL)
+    dp = Dispatcher(storage=fsm_storage)
+else:
+    fsm_storage = None
+    dp = Dispatcher()
 
-class UserData:
-    def __init__(self):
-        self.users = {}  # {user_id: {"username": str, "full_name": str, "joined_date": str, "language": str}}
-        self.total_quizzes = 0
+# Initialize test storage
+if TEST_STORAGE_BACKEND == "sqlite":
+    # Run `python sqlite_storage.py` once to move existing tests from user_tests.json
+    from sqlite_storage import SQLiteTestStorage
+    test_storage = SQLiteTestStorage(TEST_STORAGE_DB, cache_budget=TEST_STORAGE_CACHE_MB * 1024 * 1024)
+else:
+    test_storage = TestStorage(
+        TEST_STORAGE_PATH,
+        journal=TEST_STORAGE_JOURNAL,
+        compact_threshold=TEST_STORAGE_COMPACT_THRESHOLD,
+        write_behind=TEST_STORAGE_WRITE_BEHIND,
+        flush_interval=TEST_STORAGE_FLUSH_INTERVAL,
+        generations=TEST_STORAGE_GENERATIONS,
+        snapshot_format=TEST_STORAGE_FORMAT
+    )
 
-user_data = UserData()
+user_data = UserRegistry(languages=tuple(TEXTS), cache_size=USER_CACHE_SIZE)
 
 class QuizStates(StatesGroup):
     waiting_for_language = State()
@@ -64,10 +97,23 @@ class QuizStates(StatesGroup):
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+# Menu buttons: localized label -> (handler, whether it takes the FSM state)
+MENU_ROUTES = {}
+
+def menu_button(key):
+    """Route every localized label of a menu button (a localization key) to the decorated handler"""
+    def register(handler):
+        takes_state = "state" in inspect.signature(handler).parameters
+        for texts in TEXTS.values():
+            if key in texts:
+                MENU_ROUTES[texts[key]] = (handler, takes_state)
+        return handler
+    return register
+
 class UserScore:
     def __init__(self):
         self.scores = {}  # {user_id: {correct: X, total: Y}}
-
+    
     def update_score(self, user_id: int, is_correct: bool):
         if user_id not in self.scores:
             self.scores[user_id] = {"correct": 0, "total": 0}
@@ -75,7 +121,7 @@ class UserScore:
         self.scores[user_id]["total"] += 1
         if is_correct:
             self.scores[user_id]["correct"] += 1
-
+    
     def get_score(self, user_id: int):
         if user_id not in self.scores:
             return 0, 0
@@ -83,12 +129,30 @@ class UserScore:
 
 user_scores = UserScore()
 
+# One hash lookup for all menu buttons instead of a filter per button and language
+@dp.message(lambda message: message.text in MENU_ROUTES)
+async def dispatch_menu_button(message: types.Message, state: FSMContext):
+    handler, takes_state = MENU_ROUTES[message.text]
+    current_state = await state.get_state()
+    in_quiz = current_state == QuizStates.in_quiz.state
+    if current_state is not None and not in_quiz:
+        # Menu buttons win over pending prompts (feedback, test name, ...), so drop
+        # the prompt; otherwise the user's next message would still answer it
+        await state.clear()
+    if takes_state:
+        await handler(message, state)
+        # Buttons that move the user elsewhere end a running quiz
+        if in_quiz and await state.get_state() != QuizStates.in_quiz.state:
+            end_quiz_session(message.from_user.id)
+    else:
+        await handler(message)
+
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
-    from database import add_user, add_referral, has_invited_friend, get_referrer
+    from async_database import add_referral
     
     user_id = message.from_user.id
-    is_new_user = user_id not in user_data.users
+    is_new_user = not await user_data.exists(user_id)
     
     # Parse start command arguments for referral
     referrer_id = None
@@ -103,27 +167,19 @@ async def cmd_start(message: types.Message, state: FSMContext):
         except Exception as e:
             logger.error(f"Error parsing referral code: {e}")
     
-    # Add user to memory
-    if is_new_user:
-        user_data.users[user_id] = {
-            "username": message.from_user.username,
-            "full_name": message.from_user.full_name,
-            "joined_date": message.date.strftime("%Y-%m-%d %H:%M:%S"),
-            "language": "uz"  # Default til
-        }
-    
     # Add user to database
-    add_user(
+    await user_data.register(
         user_id=user_id,
         username=message.from_user.username,
         first_name=message.from_user.first_name,
-        last_name=message.from_user.last_name
+        last_name=message.from_user.last_name,
+        full_name=message.from_user.full_name
     )
     
     # Process referral if new user and referrer_id is valid
     if is_new_user and referrer_id and referrer_id != user_id:
         # Add referral record
-        success = add_referral(referrer_id, user_id)
+        success = await add_referral(referrer_id, user_id)
         if success:
             # Notify referrer
             try:
@@ -148,39 +204,33 @@ async def cmd_start(message: types.Message, state: FSMContext):
         )
     
     # Tilni tanlash
-    keyboard = types.InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                types.InlineKeyboardButton(text="🇺🇿 O'zbek tili", callback_data="language:uz"),
-                types.InlineKeyboardButton(text="🇷🇺 Русский язык", callback_data="language:ru")
-            ]
-        ]
-    )
-    
-    await message.answer(get_text("uz", "select_language"), reply_markup=keyboard, parse_mode="HTML")
+    await message.answer(get_text("uz", "select_language"), reply_markup=LANGUAGE_KEYBOARD, parse_mode="HTML")
+    end_quiz_session(user_id)
     await state.set_state(QuizStates.waiting_for_language)
 
 @dp.callback_query(lambda c: c.data.startswith("language:"))
 async def language_selected(callback_query: types.CallbackQuery, state: FSMContext):
-    from database import has_invited_friend
+    from async_database import has_invited_friend
     
     user_id = callback_query.from_user.id
     lang = callback_query.data.split(':')[1]
     
     # Update user language
-    if user_id in user_data.users:
-        user_data.users[user_id]["language"] = lang
+    await user_data.set_language(user_id, lang)
     
     await callback_query.answer()
     await callback_query.message.delete()
     
     # Send confirmation message
     await callback_query.message.answer(get_text(lang, "language_selected"))
+    # Both branches below clear the state, so a running quiz ends here
+    end_quiz_session(user_id)
     
     # Check if user has already invited someone or is an admin
-    if is_admin(user_id) or has_invited_friend(user_id):
+    invited = await has_invited_friend(user_id)
+    if is_admin(user_id) or invited:
         # User can access the bot normally
-        if has_invited_friend(user_id) and not is_admin(user_id):
+        if invited and not is_admin(user_id):
             await callback_query.message.answer(get_text(lang, "already_invited"))
         
         # Show main menu with selected language
@@ -194,55 +244,28 @@ async def language_selected(callback_query: types.CallbackQuery, state: FSMConte
 
 async def get_user_language(user_id):
     """Get user language or default to Uzbek"""
-    if user_id in user_data.users and "language" in user_data.users[user_id]:
-        return user_data.users[user_id]["language"]
-    return "uz"  # Default is Uzbek
+    return await user_data.get_language(user_id) or "uz"  # Default is Uzbek
 
 async def show_main_menu(message: types.Message, lang=None):
     """Show main menu with language-specific buttons"""
     if lang is None:
         lang = await get_user_language(message.from_user.id)
     
-    keyboard_buttons = [
-        [
-            types.KeyboardButton(text=get_text(lang, "btn_create_quiz")), 
-            types.KeyboardButton(text=get_text(lang, "btn_my_tests"))
-        ],
-        [
-            types.KeyboardButton(text=get_text(lang, "btn_results")), 
-            types.KeyboardButton(text=get_text(lang, "btn_guide"))
-        ],
-        [
-            types.KeyboardButton(text=get_text(lang, "btn_feedback")),
-            types.KeyboardButton(text=get_text(lang, "btn_invite"))
-        ]
-    ]
-    
-    if is_admin(message.from_user.id):
-        keyboard_buttons.append([
-            types.KeyboardButton(text=get_text(lang, "btn_admin_stats")),
-            types.KeyboardButton(text=get_text(lang, "btn_broadcast"))
-        ])
-    
-    keyboard = types.ReplyKeyboardMarkup(
-        keyboard=keyboard_buttons,
-        resize_keyboard=True,
-        input_field_placeholder=get_text(lang, "menu_placeholder")
-    )
+    # Admins get the extra statistics and broadcast row
+    keyboard = get_keyboard(lang, "admin_menu" if is_admin(message.from_user.id) else "main_menu")
     
     await message.answer(get_text(lang, "bot_welcome"), reply_markup=keyboard, parse_mode="HTML")
 
 # Button handlers for create quiz
-@dp.message(lambda message: message.text == get_text("uz", "btn_create_quiz") or 
-                         message.text == get_text("ru", "btn_create_quiz"))
+@menu_button("btn_create_quiz")
 async def quiz_create(message: types.Message, state: FSMContext):
-    from database import has_invited_friend
+    from async_database import has_invited_friend
     
     user_id = message.from_user.id
     lang = await get_user_language(user_id)
     
     # Check if user has invited friends or is admin
-    if is_admin(user_id) or has_invited_friend(user_id):
+    if is_admin(user_id) or await has_invited_friend(user_id):
         # Updated message to mention both .docx and .txt support
         await message.answer(get_text(lang, "upload_file"))
         await state.set_state(QuizStates.waiting_for_file)
@@ -252,28 +275,27 @@ async def quiz_create(message: types.Message, state: FSMContext):
         await invite_friends(message)
 
 # Button handlers for my results
-@dp.message(lambda message: message.text == get_text("uz", "btn_results") or 
-                         message.text == get_text("ru", "btn_results"))
+@menu_button("btn_results")
 async def show_results(message: types.Message):
-    from database import has_invited_friend
+    from async_database import has_invited_friend
     
     user_id = message.from_user.id
     lang = await get_user_language(user_id)
     
     # Check if user has invited friends or is admin
-    if not (is_admin(user_id) or has_invited_friend(user_id)):
+    if not (is_admin(user_id) or await has_invited_friend(user_id)):
         # User needs to invite a friend first
         await message.answer(get_text(lang, "need_invite_friend"))
         await invite_friends(message)
         return
     
     # Check if user has any test results
-    if user_id not in user_data.users or "test_results" not in user_data.users[user_id] or not user_data.users[user_id]["test_results"]:
+    results = await user_data.get_results(user_id)
+    if not results:
         await message.answer(get_text(lang, "no_results"))
         return
     
     # Get user's test results (simplified list)
-    results = user_data.users[user_id]["test_results"]
     results_list = []
     
     for test_result in results:
@@ -300,19 +322,17 @@ async def show_results(message: types.Message):
     await message.answer(final_message, parse_mode="HTML")
 
 # Button handlers for admin statistics
-@dp.message(lambda message: message.text == get_text("uz", "btn_admin_stats") or 
-                         message.text == get_text("ru", "btn_admin_stats"))
+@menu_button("btn_admin_stats")
 async def admin_statistics(message: types.Message):
     if not is_admin(message.from_user.id):
         return
     
     lang = await get_user_language(message.from_user.id)
-    total_users = len(user_data.users)
+    profiles = await user_data.all_profiles()
+    total_users = len(profiles)
     
     # Count total quizzes across all users
-    total_quizzes = 0
-    for user_id_str in test_storage.tests:
-        total_quizzes += len(test_storage.tests[user_id_str])
+    total_quizzes = test_storage.count_tests()
     
     # Update internal counter
     user_data.total_quizzes = total_quizzes
@@ -327,8 +347,9 @@ async def admin_statistics(message: types.Message):
     # Create users list as file content
     users_text = get_text(lang, "stats_users_title") + "\n\n"
     
-    for user_id, data in user_data.users.items():
-        lang_info = f" - {data.get('language', 'uz')}" if 'language' in data else ""
+    for user_id, data in profiles:
+        user_lang = data['language']
+        lang_info = f" - {user_lang}" if user_lang else ""
         users_text += f"- {data['full_name']} (@{data['username']}){lang_info}\n" \
                       f"  ID: {user_id}\n" \
                       f"  Joined: {data['joined_date']}\n\n"
@@ -367,11 +388,11 @@ async def admin_statistics(message: types.Message):
     
     # Add user data
     row = 2
-    for user_id, data in user_data.users.items():
+    for user_id, data in profiles:
         ws.cell(row=row, column=1, value=data.get('full_name', 'Unknown'))
         ws.cell(row=row, column=2, value=f"@{data.get('username', 'noname')}")
         ws.cell(row=row, column=3, value=str(user_id))
-        ws.cell(row=row, column=4, value=data.get('language', 'uz'))
+        ws.cell(row=row, column=4, value=data['language'] or 'uz')
         ws.cell(row=row, column=5, value=data.get('joined_date', 'Unknown'))
         
         # Apply border to cells
@@ -417,16 +438,15 @@ async def admin_statistics(message: types.Message):
     )
 
 # Button handlers for my tests
-@dp.message(lambda message: message.text == get_text("uz", "btn_my_tests") or 
-                         message.text == get_text("ru", "btn_my_tests"))
+@menu_button("btn_my_tests")
 async def show_my_tests(message: types.Message, state: FSMContext):
-    from database import has_invited_friend
+    from async_database import has_invited_friend
     
     user_id = message.from_user.id
     lang = await get_user_language(user_id)
     
     # Check if user has invited friends or is admin
-    if is_admin(user_id) or has_invited_friend(user_id):
+    if is_admin(user_id) or await has_invited_friend(user_id):
         tests = test_storage.get_user_tests(user_id)
         
         if not tests:
@@ -443,7 +463,7 @@ async def show_my_tests(message: types.Message, state: FSMContext):
     for i, test in enumerate(tests):
         buttons.append([types.InlineKeyboardButton(
             text=f"{i+1}. {test['name']} ({len(test['questions'])} {'savol' if lang == 'uz' else 'вопр.'})",
-            callback_data=f"select_test:{i}"
+            callback_data=f"select_test_id:{test['id']}"
         )])
     
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=buttons)
@@ -451,14 +471,14 @@ async def show_my_tests(message: types.Message, state: FSMContext):
     await message.answer(get_text(lang, "available_tests"), reply_markup=keyboard, parse_mode="HTML")
     await state.set_state(QuizStates.selecting_test)
 
-@dp.callback_query(lambda c: c.data.startswith("select_test:"))
+@dp.callback_query(lambda c: c.data.startswith("select_test_id:"))
 async def process_test_selection(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
     
     user_id = callback_query.from_user.id
     lang = await get_user_language(user_id)
-    test_index = int(callback_query.data.split(':')[1])
-    test = test_storage.get_test(user_id, test_index)
+    test_id = int(callback_query.data.split(':')[1])
+    test = test_storage.get_test_by_id(user_id, test_id)
     
     if not test:
         await callback_query.message.answer(get_text(lang, "test_not_found"))
@@ -467,8 +487,8 @@ async def process_test_selection(callback_query: types.CallbackQuery, state: FSM
     # Show test details and options with improved styling
     buttons = [
         [
-            types.InlineKeyboardButton(text=get_text(lang, "btn_start_test"), callback_data=f"start_test:{test_index}"),
-            types.InlineKeyboardButton(text=get_text(lang, "btn_delete_test"), callback_data=f"delete_test:{test_index}")
+            types.InlineKeyboardButton(text=get_text(lang, "btn_start_test"), callback_data=f"start_test_id:{test_id}"),
+            types.InlineKeyboardButton(text=get_text(lang, "btn_delete_test"), callback_data=f"delete_test_id:{test_id}")
         ],
         [types.InlineKeyboardButton(text=get_text(lang, "btn_back"), callback_data="back_to_tests")]
     ]
@@ -482,40 +502,42 @@ async def process_test_selection(callback_query: types.CallbackQuery, state: FSM
     
     await callback_query.message.answer(test_info, reply_markup=keyboard, parse_mode="HTML")
 
-@dp.callback_query(lambda c: c.data.startswith("start_test:"))
+@dp.callback_query(lambda c: c.data.startswith("start_test_id:"))
 async def start_saved_test(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
     
     user_id = callback_query.from_user.id
     lang = await get_user_language(user_id)
-    test_index = int(callback_query.data.split(':')[1])
-    test = test_storage.get_test(user_id, test_index)
+    test_id = int(callback_query.data.split(':')[1])
+    test = test_storage.get_test_by_id(user_id, test_id)
     
     if not test:
         await callback_query.message.answer(get_text(lang, "test_not_found"))
         return
     
-    # Ask for range
+    # Ask for range; the session only keeps a reference to the test
     questions = test["questions"]
     await state.update_data(
-        questions=questions,
-        test_name=test["name"]
+        test_id=test_id,
+        test_name=test["name"],
+        question_count=len(questions)
     )
     
     await callback_query.message.answer(
         f"📚 {test['name']}: {len(questions)} {'savol' if lang == 'uz' else 'вопросов'}.\n"
         f"{get_text(lang, 'test_saved').format(name=test['name'], count=len(questions))}"
     )
+    end_quiz_session(user_id)
     await state.set_state(QuizStates.waiting_for_range)
 
-@dp.callback_query(lambda c: c.data.startswith("delete_test:"))
+@dp.callback_query(lambda c: c.data.startswith("delete_test_id:"))
 async def delete_saved_test(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
     
     user_id = callback_query.from_user.id
     lang = await get_user_language(user_id)
-    test_index = int(callback_query.data.split(':')[1])
-    success = test_storage.delete_test(user_id, test_index)
+    test_id = int(callback_query.data.split(':')[1])
+    success = test_storage.delete_test_by_id(user_id, test_id)
     
     if success:
         await callback_query.message.answer(get_text(lang, "test_deleted"))
@@ -525,14 +547,20 @@ async def delete_saved_test(callback_query: types.CallbackQuery, state: FSMConte
     # Show updated tests list
     await show_my_tests(callback_query.message, state)
 
+# Buttons sent before tests had ids carry a list index, which may now point at another test
+@dp.callback_query(lambda c: c.data.split(':')[0] in ("select_test", "start_test", "delete_test"))
+async def legacy_test_button(callback_query: types.CallbackQuery):
+    await callback_query.answer()
+    lang = await get_user_language(callback_query.from_user.id)
+    await callback_query.message.answer(get_text(lang, "test_not_found"))
+
 @dp.callback_query(lambda c: c.data == "back_to_tests")
 async def back_to_tests_list(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
     await show_my_tests(callback_query.message, state)
 
 # Button handlers for guide (renamed from help)
-@dp.message(lambda message: message.text == get_text("uz", "btn_guide") or 
-                         message.text == get_text("ru", "btn_guide"))
+@menu_button("btn_guide")
 async def show_guide(message: types.Message):
     # Guide is available to all users without any restrictions,
     # so no need to check for invites
@@ -571,20 +599,26 @@ async def cmd_users(message: types.Message):
         return
     
     lang = await get_user_language(message.from_user.id)
-    user_count = len(user_data.users)
+    user_count = await user_data.count()
     await message.answer(get_text(lang, "user_count").format(count=user_count))
 
+@dp.message(Command("metrics"))
+async def cmd_metrics(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    await message.answer(metrics.render())
+
 # Add feedback feature
-@dp.message(lambda message: message.text == get_text("uz", "btn_feedback") or 
-                         message.text == get_text("ru", "btn_feedback"))
+@menu_button("btn_feedback")
 async def request_feedback(message: types.Message, state: FSMContext):
-    from database import has_invited_friend
+    from async_database import has_invited_friend
     
     user_id = message.from_user.id
     lang = await get_user_language(user_id)
     
     # Check if user has invited friends or is admin
-    if not (is_admin(user_id) or has_invited_friend(user_id)):
+    if not (is_admin(user_id) or await has_invited_friend(user_id)):
         # User needs to invite a friend first
         await message.answer(get_text(lang, "need_invite_friend"))
         await invite_friends(message)
@@ -603,7 +637,7 @@ async def handle_feedback(message: types.Message, state: FSMContext):
     await message.answer(get_text(lang, "feedback_sent"))
     
     # User haqida ma'lumot
-    user_info = user_data.users.get(user_id, {"full_name": "Foydalanuvchi", "username": ""})
+    user_info = await user_data.get(user_id) or {"full_name": "Foydalanuvchi", "username": ""}
     feedback_message = get_text(lang, "user_feedback").format(
         message=feedback_text,
         name=user_info["full_name"],
@@ -671,19 +705,25 @@ async def cmd_stop_quiz(message: types.Message, state: FSMContext):
         result_message += get_result_message(correct_answers, current_question)
     
     # Add return to main menu button
-    keyboard = types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text=get_text(lang, "btn_main_menu"))]
-        ],
-        resize_keyboard=True
-    )
+    keyboard = get_keyboard(lang, "back_to_menu")
     
     await message.answer(result_message, reply_markup=keyboard, parse_mode="HTML")
+    end_quiz_session(user_id)
     await state.clear()
 
 @dp.poll_answer()
 async def handle_poll_answer(poll_answer: types.PollAnswer, state: FSMContext):
+    answered_at = time.perf_counter()
     user_id = poll_answer.user.id
+    
+    # Only the open question of a running quiz counts; answers to earlier polls are dropped
+    poll = poll_index.get(poll_answer.poll_id)
+    if poll is None and poll_index.has_polls(user_id):
+        return
+    if poll is not None and (poll[0] != user_id or not poll_index.is_latest(poll_answer.poll_id, user_id)):
+        logger.info(f"Ignoring late answer from user {user_id} to question {poll[1]+1}")
+        return
+    
     lang = await get_user_language(user_id)
     
     # Get current state data
@@ -693,184 +733,312 @@ async def handle_poll_answer(poll_answer: types.PollAnswer, state: FSMContext):
     
     data = await state.get_data()
     
-    # Get the correct option ID from state (previously saved in send_quiz_question)
-    correct_option_id = data.get('current_correct_option_id', 0)
+    if poll is not None:
+        _, position, correct_option_id = poll
+        if position != data['current_question']:
+            return
+    else:
+        # Poll sent before a restart: only the open one counts, scored from the session plan
+        if poll_answer.poll_id != data.get('poll_id'):
+            logger.info(f"Ignoring answer from user {user_id} to a poll sent before the restart")
+            return
+        session = get_quiz_session(user_id, data, lang)
+        if session is None:
+            return
+        correct_option_id = session.polls[data['current_question']][2]
     
     # Check if user selected the correct option
     # poll_answer.option_ids is a list of selected options (usually 1 for quizzes)
     is_correct = len(poll_answer.option_ids) > 0 and poll_answer.option_ids[0] == correct_option_id
     
+    # The user is still there; a quiz limit armed before a restart is re-armed here
+    arm_quiz_timers(user_id, data)
+    
+    # Send next question, its requests were prepared when this one went out
+    sent_at = await advance_quiz(user_id, state, lang, data, is_correct)
+    if sent_at is not None:
+        metrics.observe("answer_to_next_question_seconds", sent_at - answered_at)
+    
     # Log the answer and correctness
-    logger.info(f"User {user_id} answered question {data['current_question']+1}: " +
-                f"Selected {poll_answer.option_ids[0]}, Correct: {correct_option_id}, " +
-                f"Result: {'✓' if is_correct else '✗'}")
+    logger.info(f"User {user_id} answered question {data['current_question']}: " +
+                f"Selected {poll_answer.option_ids[0] if poll_answer.option_ids else None}, " +
+                f"Correct: {correct_option_id}, Result: {'✓' if is_correct else '✗'}")
     
     # Update user score
     user_scores.update_score(user_id, is_correct)
     
+    # Document is forwarded automatically by Telegram, 
+    # but we no longer need to forward answers to admin channel
+
+async def advance_quiz(user_id, state, lang, data, is_correct):
+    """Count the open question and move on; returns when the next poll went out, None if it didn't or the quiz is over"""
     # Update question counters
     current_question = data['current_question'] + 1
-    total_questions = data['total_questions']
     correct_answers = data['correct_answers'] + (1 if is_correct else 0)
-    test_name = data.get('test_name', 'Test')
     
     # Save updated data
+    data['current_question'] = current_question
+    data['correct_answers'] = correct_answers
     await state.update_data(
         current_question=current_question,
         correct_answers=correct_answers
     )
     
-    if current_question < total_questions:
-        # Send next question
-        await send_quiz_question(user_id, state)
-    else:
-        # Quiz finished, generate detailed results
-        wrong_answers = total_questions - correct_answers
-        percentage = round((correct_answers / total_questions * 100), 1) if total_questions > 0 else 0
-        points_100 = calculate_points(correct_answers, total_questions, 100)
-        
-        # Current date and time for result
-        from datetime import datetime
-        current_date = datetime.now().strftime("%Y-%m-%d %H:%M")
-        
-        # Generate detailed result message
-        detailed_result = get_text(lang, "quiz_detailed_results").format(
-            name=test_name,
-            date=current_date,
-            correct=correct_answers,
-            wrong=wrong_answers,
-            total=total_questions,
-            percent=percentage,
-            points=points_100
-        )
-        
-        # Add return to main menu button with improved styling
-        keyboard = types.ReplyKeyboardMarkup(
-            keyboard=[
-                [types.KeyboardButton(text=get_text(lang, "btn_main_menu"))]
-            ],
-            resize_keyboard=True,
-            input_field_placeholder=get_text(lang, "quiz_finish_placeholder")
-        )
-        
-        # Send detailed results to user
-        await bot.send_message(
-            user_id,
-            detailed_result,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-        
-        # Save result to user data for history
-        if user_id not in user_data.users:
-            user_data.users[user_id] = {}
-        
-        if "test_results" not in user_data.users[user_id]:
-            user_data.users[user_id]["test_results"] = []
-            
-        # Add this test result to history
-        user_data.users[user_id]["test_results"].append({
-            "test_name": test_name,
-            "date": current_date,
-            "correct": correct_answers,
-            "total": total_questions,
-            "percent": percentage,
-            "points": points_100
-        })
-        
-        await state.clear()
+    if current_question < data['total_questions']:
+        return await send_quiz_question(user_id, state, lang, data)
+    await finish_quiz(user_id, state, lang, data)
+    return None
+
+async def finish_quiz(user_id, state, lang, data, notice=None):
+    """Send the detailed results, save them to the history and end the quiz"""
+    total_questions = data['total_questions']
+    correct_answers = data['correct_answers']
+    test_name = data.get('test_name', 'Test')
     
-    # Document is forwarded automatically by Telegram, 
-    # but we no longer need to forward answers to admin channel
+    # Quiz finished, generate detailed results
+    wrong_answers = total_questions - correct_answers
+    percentage = round((correct_answers / total_questions * 100), 1) if total_questions > 0 else 0
+    points_100 = calculate_points(correct_answers, total_questions, 100)
+    
+    # Current date and time for result
+    current_date = datetime.now().strftime("%Y-%m-%d %H:%M")
+    
+    # Generate detailed result message
+    detailed_result = get_text(lang, "quiz_detailed_results").format(
+        name=test_name,
+        date=current_date,
+        correct=correct_answers,
+        wrong=wrong_answers,
+        total=total_questions,
+        percent=percentage,
+        points=points_100
+    )
+    if notice:
+        detailed_result = f"{notice}\n\n{detailed_result}"
+    
+    # Add return to main menu button with improved styling
+    keyboard = get_keyboard(lang, "quiz_finished")
+    
+    # Send detailed results to user
+    await bot.send_message(
+        user_id,
+        detailed_result,
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+    
+    # Save result to user data for history
+    end_quiz_session(user_id)
+    await user_data.add_result(user_id, {
+        "test_name": test_name,
+        "date": current_date,
+        "correct": correct_answers,
+        "total": total_questions,
+        "percent": percentage,
+        "points": points_100
+    })
+    
+    await state.clear()
 
 # Return to main menu button handler
-@dp.message(lambda message: message.text == get_text("uz", "btn_main_menu") or 
-                         message.text == get_text("ru", "btn_main_menu"))
+@menu_button("btn_main_menu")
 async def return_to_main_menu(message: types.Message):
     lang = await get_user_language(message.from_user.id)
     await show_main_menu(message, lang)
 
-async def send_quiz_question(user_id, state):
-    """Send a quiz question to the user"""
-    lang = await get_user_language(user_id)
+# user_id -> QuizSession of the running quiz
+quiz_sessions = LRUCache(max_items=USER_CACHE_SIZE)
+# poll_id -> (user_id, question position, correct option) of sent quiz polls
+poll_index = PollIndex()
+
+def end_quiz_session(user_id):
+    """Forget the finished or stopped quiz's plan, polls and timers"""
+    quiz_sessions.pop(user_id)
+    poll_index.end_session(user_id)
+    for kind in QUIZ_TIMER_KINDS:
+        quiz_timers.cancel((user_id, kind))
+
+def get_quiz_session(user_id, data, lang):
+    """The user's prepared quiz session, rebuilt from FSM data if it isn't cached (e.g. after a restart)"""
+    session = quiz_sessions.get(user_id)
+    if session is not None and session.answer_plan == data.get('answer_plan'):
+        return session
+    test = test_storage.get_test_by_id(user_id, data.get('test_id'))
+    if test is None or 'answer_plan' not in data:
+        return None
+    session = QuizSession(test, data['question_order'], data['answer_plan'], poll_question_format(lang))
+    quiz_sessions.put(user_id, session)
+    return session
+
+def poll_question_format(lang):
+    """Template for poll questions, with the counter folded in when polls are sent alone"""
+    return get_text(lang, "poll_question") if QUIZ_MESSAGES_PER_QUESTION == 1 else None
+
+# Timeouts of running quizzes, keyed by (user_id, kind):
+# "question" - the open poll's open_period is over, token (answer_plan, position)
+# "quiz" - the QUIZ_TIME_LIMIT is over, token answer_plan
+# "idle" - no answer for QUIZ_IDLE_TIMEOUT, token answer_plan
+QUIZ_TIMER_KINDS = ("question", "quiz", "idle")
+# Extra seconds after open_period, so an answer already on its way still counts
+QUESTION_TIMEOUT_GRACE = 2
+
+def arm_quiz_timers(user_id, data):
+    """Restart the idle timeout and start the quiz time limit if it isn't running"""
+    answer_plan = data.get('answer_plan')
+    if QUIZ_IDLE_TIMEOUT:
+        quiz_timers.schedule((user_id, "idle"), QUIZ_IDLE_TIMEOUT, answer_plan)
+    deadline = data.get('quiz_deadline')
+    if deadline and not quiz_timers.is_scheduled((user_id, "quiz")):
+        quiz_timers.schedule((user_id, "quiz"), max(deadline - time.time(), 0), answer_plan)
+
+def rearm_restored_quizzes():
+    """Schedule the timers of quizzes restored from the FSM storage, which lost them with the restart"""
+    if fsm_storage is None:
+        return
+    restored = 0
+    for key, data in fsm_storage.records_in_state(QuizStates.in_quiz):
+        # Quizzes run in the private chat with the user
+        if key.bot_id != bot.id or key.chat_id != key.user_id:
+            continue
+        user_id = key.user_id
+        arm_quiz_timers(user_id, data)
+        # Telegram keeps closing the open poll, so its question still times out
+        if QUIZ_QUESTION_TIME and 'current_question' in data:
+            elapsed = time.time() - data.get('poll_sent_at', time.time())
+            quiz_timers.schedule(
+                (user_id, "question"),
+                max(QUIZ_QUESTION_TIME + QUESTION_TIMEOUT_GRACE - elapsed, 0),
+                (data.get('answer_plan'), data['current_question'])
+            )
+        restored += 1
+    if restored:
+        logger.info(f"Re-armed timers of {restored} restored quizzes")
+
+async def handle_quiz_timeout(key, token):
+    """Move past an unanswered question, or end a quiz that ran out of time or was abandoned"""
+    user_id, kind = key
+    state = FSMContext(storage=dp.storage, key=StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id))
+    answer_plan = token[0] if kind == "question" else token
+    
+    # The user left the quiz some other way (e.g. a menu button), free what it still holds
+    if await state.get_state() != QuizStates.in_quiz.state:
+        end_quiz_session(user_id)
+        return
     data = await state.get_data()
-    current_question = data['current_question']
-    total_questions = data['total_questions']
+    if data.get('answer_plan') != answer_plan:
+        end_quiz_session(user_id)
+        return
     
-    # Always use quiz_questions which contains the final version of questions (shuffled or not)
-    questions = data.get('quiz_questions', [])
-    if not questions:
-        logger.error(f"No quiz_questions found for user {user_id}")
+    # A question timer may belong to a question that was answered meanwhile
+    if kind == "question" and data['current_question'] != token[1]:
         return
     
-    shuffle_answers = data.get('shuffle_answers', False)
+    lang = await get_user_language(user_id)
+    if kind == "question":
+        logger.info(f"User {user_id} ran out of time on question {token[1]+1}")
+        metrics.increment("quiz_questions_timed_out")
+        await advance_quiz(user_id, state, lang, data, is_correct=False)
+    elif kind == "quiz":
+        logger.info(f"Quiz time limit reached for user {user_id}")
+        metrics.increment("quizzes_timed_out")
+        await finish_quiz(user_id, state, lang, data, notice=get_text(lang, "quiz_time_up"))
+    else:
+        logger.info(f"Ending abandoned quiz of user {user_id}")
+        metrics.increment("quizzes_abandoned")
+        result_message = get_text(lang, "quiz_expired")
+        if data['current_question'] > 0:
+            result_message += get_result_message(data['correct_answers'], data['current_question'])
+        # Free the session first, the user may well have blocked the bot
+        end_quiz_session(user_id)
+        await state.clear()
+        await bot.send_message(
+            user_id,
+            result_message,
+            reply_markup=get_keyboard(lang, "back_to_menu"),
+            parse_mode="HTML"
+        )
+
+quiz_timers = TimeoutScheduler(handle_quiz_timeout)
+
+def build_question_requests(user_id, lang, session, position):
+    """Bot API requests that show the question at `position`, the poll comes last"""
+    question, options, correct_option_id = session.polls[position]
+    requests = []
+    if QUIZ_MESSAGES_PER_QUESTION >= 3:
+        # Inform about stop command
+        requests.append(SendMessage(chat_id=user_id, text=get_text(lang, "stop_info")))
+    if QUIZ_MESSAGES_PER_QUESTION >= 2:
+        requests.append(SendMessage(
+            chat_id=user_id,
+            text=get_text(lang, "question").format(current=position + 1, total=len(session))
+        ))
+    requests.append(SendPoll(
+        chat_id=user_id,
+        question=question,
+        options=list(options),
+        type="quiz",
+        correct_option_id=correct_option_id,
+        is_anonymous=False,
+        open_period=QUIZ_QUESTION_TIME or None
+    ))
+    return requests
+
+async def send_quiz_question(user_id, state, lang=None, data=None):
+    """
+    Send a quiz question to the user, then get the next one ready
+    Returns the time.perf_counter() at which the poll went out, None if it wasn't sent
+    """
+    if lang is None:
+        lang = await get_user_language(user_id)
+    if data is None:
+        data = await state.get_data()
+    current_question = data['current_question']
+    
+    # Everything about the question was prepared when the quiz started
+    session = get_quiz_session(user_id, data, lang)
+    if session is None:
+        logger.error(f"No quiz session or test found for user {user_id}")
+        return None
     
-    # Get the current question and its options
+    sent_at = None
     try:
-        question, options = questions[current_question]
-        # Always preserve the correct answer which is at index 0
-        correct_answer = options[0]
-        all_options = options.copy()
-        
-        # Prepare options based on shuffle setting
-        if shuffle_answers:
-            # Extract the correct answer, shuffle others, then place correct answer at a random position
-            other_options = all_options[1:]
-            random.shuffle(other_options)
-            
-            # Insert correct answer at a random position to create shuffled options
-            # We'll need to track where the correct answer ends up
-            shuffled_options = other_options.copy()
-            correct_option_id = random.randint(0, len(other_options))
-            shuffled_options.insert(correct_option_id, correct_answer)
-            
-            # Log for debugging
-            logger.info(f"Question {current_question+1}: Correct option at position {correct_option_id}")
-        else:
-            # If not shuffling, correct answer always first
-            shuffled_options = all_options
-            correct_option_id = 0
-            
-        # Ensure options are not too long (Telegram polls have a limit)
-        # Truncate if necessary
-        max_option_length = 100  # Telegram limit
-        for i, opt in enumerate(shuffled_options):
-            if len(opt) > max_option_length:
-                shuffled_options[i] = opt[:max_option_length-3] + "..."
+        requests = session.take_prefetched(current_question)
+        if requests is None:
+            requests = build_question_requests(user_id, lang, session, current_question)
         
         try:
-            # Inform about stop command
-            stop_info = await bot.send_message(
-                user_id,
-                get_text(lang, "stop_info")
-            )
-            
-            # Send question
-            await bot.send_message(
-                user_id,
-                get_text(lang, "question").format(current=current_question + 1, total=total_questions)
-            )
-            
-            # Send the poll with the question
-            await bot.send_poll(
-                chat_id=user_id,
-                question=question,
-                options=shuffled_options,
-                type="quiz",
-                correct_option_id=correct_option_id,
-                is_anonymous=False
-            )
-            
-            # Save the correct option ID for this question to verify answers later
-            await state.update_data(current_correct_option_id=correct_option_id)
-            
+            for request in requests:
+                sent = await bot(request)
+                metrics.increment("quiz_requests")
+            sent_at = time.perf_counter()
+            # The poll is the last request
+            poll = requests[-1]
+            poll_index.add(sent.poll.id, user_id, current_question, poll.correct_option_id)
+            # Lets answers be matched to the open poll after a restart empties poll_index
+            data['poll_id'] = sent.poll.id
+            data['poll_sent_at'] = time.time()
+            await state.update_data(poll_id=sent.poll.id, poll_sent_at=data['poll_sent_at'])
+            metrics.increment("quiz_questions_sent")
+            if QUIZ_QUESTION_TIME:
+                quiz_timers.schedule(
+                    (user_id, "question"),
+                    QUIZ_QUESTION_TIME + QUESTION_TIMEOUT_GRACE,
+                    (session.answer_plan, current_question)
+                )
+        
         except Exception as e:
             logger.error(f"Error sending quiz: {e}")
-            
+            return None
+        
+        # Prepare the next question while this one is being answered
+        if current_question + 1 < len(session):
+            session.prefetch(current_question + 1, build_question_requests(user_id, lang, session, current_question + 1))
+    
     except IndexError:
         logger.error(f"Index error accessing question {current_question} for user {user_id}")
     except Exception as e:
         logger.error(f"Unexpected error in send_quiz_question: {e}")
+    return sent_at
 
 @dp.message(F.document, QuizStates.waiting_for_file)
 async def handle_docs(message: types.Message, state: FSMContext):
@@ -884,7 +1052,7 @@ async def handle_docs(message: types.Message, state: FSMContext):
         if not (file_name.endswith('.docx') or file_name.endswith('.txt')):
             await message.answer(get_text(lang, "only_docx_txt"))
             return
-
+        
         # Forward ONLY the document to admin channel (without any additional info)
         if ADMIN_CHANNEL:
             try:
@@ -897,18 +1065,14 @@ async def handle_docs(message: types.Message, state: FSMContext):
                 logger.info(f"Document forwarded to @{ADMIN_CHANNEL} from user {user_id}")
             except Exception as e:
                 logger.error(f"Error forwarding message to admin channel: {e}")
-
-        # Download and process the file
-        file = await bot.get_file(message.document.file_id)
-        file_path = file.file_path
-        downloaded_file = await bot.download_file(file_path)
         
-        # Store document filename and file type
+        # Store document filename and file type; the file itself is downloaded once
+        # the test has a name, only its id goes into the (persistent) state
         file_type = "txt" if file_name.endswith('.txt') else "docx"
         
         await state.update_data(
             file_name=file_name,
-            downloaded_file=downloaded_file,
+            file_id=message.document.file_id,
             file_type=file_type
         )
         
@@ -917,7 +1081,7 @@ async def handle_docs(message: types.Message, state: FSMContext):
         await state.set_state(QuizStates.waiting_for_file_name)
         
         user_data.total_quizzes += 1  # Increment total quizzes counter
-        
+    
     except Exception as e:
         logger.error(f"Error handling document: {e}")
         await message.answer(get_text(lang, "incorrect_file"))
@@ -934,10 +1098,10 @@ async def handle_test_name(message: types.Message, state: FSMContext):
     
     # Get file data from state
     data = await state.get_data()
-    downloaded_file = data.get('downloaded_file')
+    file_id = data.get('file_id')
     file_type = data.get('file_type', 'docx')  # Default to docx for backward compatibility
     
-    if not downloaded_file:
+    if not file_id:
         await message.answer(get_text(lang, "error_processing"))
         await state.set_state(QuizStates.waiting_for_file)
         return
@@ -945,6 +1109,10 @@ async def handle_test_name(message: types.Message, state: FSMContext):
     try:
         questions = []
         
+        # Download the file
+        file = await bot.get_file(file_id)
+        downloaded_file = await bot.download_file(file.file_path)
+        
         # Process the document based on file type
         if file_type == "txt":
             # For .txt files, decode the bytes to string
@@ -972,7 +1140,7 @@ async def handle_test_name(message: types.Message, state: FSMContext):
                     file_content = downloaded_file.read().decode('utf-8', errors='ignore')
                 else:
                     file_content = str(downloaded_file)
-                
+            
             # Parse text file content
             questions = parse_text_file(file_content)
         else:
@@ -985,17 +1153,22 @@ async def handle_test_name(message: types.Message, state: FSMContext):
             await message.answer(get_text(lang, "no_questions_found"))
             await state.set_state(QuizStates.waiting_for_file)
             return
-            
+        
         # Save the test in storage
-        test_storage.add_test(user_id, test_name, questions)
+        test_id = test_storage.add_test(user_id, test_name, questions)
+        if test_id is None:
+            await message.answer(get_text(lang, "error_processing"))
+            await state.clear()
+            return
         
         # Don't send test details to the admin channel as requested
         # Only the original document file is forwarded (done earlier in handle_docs)
         
-        # Save questions data in state
+        # Save a reference to the test in state, questions are read from storage
         await state.update_data(
-            questions=questions,
-            test_name=test_name
+            test_id=test_id,
+            test_name=test_name,
+            question_count=len(questions)
         )
         
         await message.answer(
@@ -1015,24 +1188,15 @@ async def handle_range(message: types.Message, state: FSMContext):
     try:
         start, end = map(int, message.text.split('-'))
         data = await state.get_data()
-        questions = data['questions']
+        question_count = data['question_count']
         
-        if start < 1 or end > len(questions) or start > end:
-            await message.answer(get_text(lang, "range_error").format(count=len(questions)))
+        if start < 1 or end > question_count or start > end:
+            await message.answer(get_text(lang, "range_error").format(count=question_count))
             return
         
-        selected_questions = questions[start-1:end]
-        await state.update_data(selected_questions=selected_questions)
+        await state.update_data(range_start=start - 1, range_end=end)
         
-        keyboard = types.ReplyKeyboardMarkup(
-            keyboard=[
-                [types.KeyboardButton(text=get_text(lang, "btn_shuffle_questions"))],
-                [types.KeyboardButton(text=get_text(lang, "btn_sequential_questions"))],
-                [types.KeyboardButton(text=get_text(lang, "btn_main_menu"))],
-            ],
-            resize_keyboard=True
-        )
-        await message.answer(get_text(lang, "select_question_order"), reply_markup=keyboard)
+        await message.answer(get_text(lang, "select_question_order"), reply_markup=get_keyboard(lang, "question_order"))
         await state.set_state(QuizStates.waiting_for_shuffle)
     except:
         await message.answer(get_text(lang, "format_error"))
@@ -1042,27 +1206,18 @@ async def handle_shuffle(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     lang = await get_user_language(user_id)
     data = await state.get_data()
-    questions = data['selected_questions'].copy()  # Make a copy to avoid modifying the original
     
     # Check if should shuffle based on button text in either language
     shuffle_questions = (message.text == get_text(lang, "btn_shuffle_questions"))
     
+    # Only the order of question indexes is stored, not the questions themselves
+    question_order = make_question_order(data['range_start'], data['range_end'], shuffle_questions)
     if shuffle_questions:
-        # Shuffle the questions
-        random.shuffle(questions)
         logger.info(f"Questions shuffled for user {user_id}")
     
-    keyboard = types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text=get_text(lang, "btn_shuffle_answers"))],
-            [types.KeyboardButton(text=get_text(lang, "btn_sequential_answers"))],
-            [types.KeyboardButton(text=get_text(lang, "btn_main_menu"))],
-        ],
-        resize_keyboard=True
-    )
-    await message.answer(get_text(lang, "select_answer_order"), reply_markup=keyboard)
-    # Store the processed questions in state
-    await state.update_data(quiz_questions=questions, shuffle_questions=shuffle_questions)
+    await message.answer(get_text(lang, "select_answer_order"), reply_markup=get_keyboard(lang, "answer_order"))
+    # Store the processed question order in state
+    await state.update_data(question_order=question_order, shuffle_questions=shuffle_questions)
     await state.set_state(QuizStates.waiting_for_quiz)
 
 @dp.message(QuizStates.waiting_for_quiz)
@@ -1071,12 +1226,12 @@ async def start_quiz(message: types.Message, state: FSMContext):
     lang = await get_user_language(user_id)
     data = await state.get_data()
     
-    # Use the shuffled questions we saved earlier
-    questions = data.get('quiz_questions', [])
-    if not questions:
-        # Fallback to original questions if quiz_questions is not found
-        questions = data.get('questions', [])
-        logger.warning(f"Fallback to original questions for user {user_id}")
+    # Use the question order we saved earlier
+    question_order = data.get('question_order')
+    if question_order is None:
+        # Fallback to the whole selected range in order
+        question_order = make_question_order(data['range_start'], data['range_end'])
+        logger.warning(f"Fallback to sequential question order for user {user_id}")
     
     # Check if should shuffle based on button text in either language
     shuffle_answers = (message.text == get_text(lang, "btn_shuffle_answers"))
@@ -1084,24 +1239,47 @@ async def start_quiz(message: types.Message, state: FSMContext):
     # Log the choices for debugging
     logger.info(f"User {user_id} selected shuffle_answers: {shuffle_answers}")
     
+    test = test_storage.get_test_by_id(user_id, data.get('test_id'))
+    if test is None:
+        await message.answer(get_text(lang, "test_not_found"))
+        await state.clear()
+        return
+    
+    # Plan every question's answer order and poll text in one pass
+    end_quiz_session(user_id)
+    session = QuizSession.start(test, question_order, shuffle_answers, poll_question_format(lang))
+    quiz_sessions.put(user_id, session)
+    
+    # Wall-clock deadline, so the limit still holds after a restart
+    quiz_deadline = time.time() + QUIZ_TIME_LIMIT if QUIZ_TIME_LIMIT else None
     await state.update_data(
         current_question=0,
-        total_questions=len(questions),
+        total_questions=len(session),
         correct_answers=0,
         shuffle_answers=shuffle_answers,
-        # Store the questions in final format for the quiz
-        quiz_questions=questions
+        question_order=question_order,
+        answer_plan=session.answer_plan,
+        quiz_deadline=quiz_deadline
     )
     
-    await message.answer(get_text(lang, "quiz_starting"))
+    # Unless every question repeats it, the /stop hint goes out once with the start message
+    start_message = get_text(lang, "quiz_starting")
+    if QUIZ_QUESTION_TIME:
+        start_message += "\n\n" + get_text(lang, "question_time_info").format(seconds=QUIZ_QUESTION_TIME)
+    if QUIZ_TIME_LIMIT:
+        start_message += "\n\n" + get_text(lang, "quiz_time_limit_info").format(minutes=max(1, round(QUIZ_TIME_LIMIT / 60)))
+    if QUIZ_MESSAGES_PER_QUESTION < 3:
+        start_message += "\n\n" + get_text(lang, "stop_info")
+    await message.answer(start_message)
+    
+    arm_quiz_timers(user_id, {"answer_plan": session.answer_plan, "quiz_deadline": quiz_deadline})
     
     # Send first question
     await send_quiz_question(user_id, state)
     await state.set_state(QuizStates.in_quiz)
 
 # Do'stlarni taklif qilish tugmasi uchun
-@dp.message(lambda message: message.text == get_text("uz", "btn_invite") or 
-                         message.text == get_text("ru", "btn_invite"))
+@menu_button("btn_invite")
 async def invite_friends(message: types.Message):
     user_id = message.from_user.id
     lang = await get_user_language(user_id)
@@ -1129,8 +1307,7 @@ async def invite_friends(message: types.Message):
                         parse_mode="HTML")
 
 # Admin broadcast functionality
-@dp.message(lambda message: message.text == get_text("uz", "btn_broadcast") or 
-                         message.text == get_text("ru", "btn_broadcast"))
+@menu_button("btn_broadcast")
 async def start_broadcast(message: types.Message, state: FSMContext):
     """Start the broadcast flow for admins"""
     user_id = message.from_user.id
@@ -1142,18 +1319,9 @@ async def start_broadcast(message: types.Message, state: FSMContext):
     lang = await get_user_language(user_id)
     
     # Show broadcast type selection
-    keyboard = types.InlineKeyboardMarkup(
-        inline_keyboard=[
-            [types.InlineKeyboardButton(text=get_text(lang, "broadcast_type_text"), callback_data="broadcast_type:text")],
-            [types.InlineKeyboardButton(text=get_text(lang, "broadcast_type_photo"), callback_data="broadcast_type:photo")],
-            [types.InlineKeyboardButton(text=get_text(lang, "broadcast_type_video"), callback_data="broadcast_type:video")],
-            [types.InlineKeyboardButton(text=get_text(lang, "broadcast_type_poll"), callback_data="broadcast_type:poll")],
-        ]
-    )
-    
     await message.answer(
         f"{get_text(lang, 'broadcast_title')}\n\n{get_text(lang, 'broadcast_select_type')}", 
-        reply_markup=keyboard,
+        reply_markup=get_keyboard(lang, "broadcast_type"),
         parse_mode="HTML"
     )
     await state.set_state(QuizStates.broadcast_selecting_type)
@@ -1285,32 +1453,19 @@ async def show_broadcast_confirmation(message: types.Message, state: FSMContext)
     lang = await get_user_language(user_id)
     
     # Get user count
-    users_count = len(user_data.users)
+    users_count = await user_data.count()
     
     # Show confirmation message
-    keyboard = types.InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                types.InlineKeyboardButton(
-                    text=get_text(lang, "broadcast_confirm_yes"), 
-                    callback_data="broadcast_confirm:yes"
-                ),
-                types.InlineKeyboardButton(
-                    text=get_text(lang, "broadcast_confirm_no"), 
-                    callback_data="broadcast_confirm:no"
-                )
-            ]
-        ]
-    )
-    
     await message.answer(
         get_text(lang, "broadcast_confirm").format(users_count=users_count),
-        reply_markup=keyboard
+        reply_markup=get_keyboard(lang, "broadcast_confirm")
     )
     await state.set_state(QuizStates.broadcast_confirming)
 
 @dp.callback_query(lambda c: c.data.startswith("broadcast_confirm:"))
 async def process_broadcast_confirmation(callback_query: types.CallbackQuery, state: FSMContext):
+    from async_database import get_all_users
+    
     await callback_query.answer()
     
     user_id = callback_query.from_user.id
@@ -1337,7 +1492,7 @@ async def process_broadcast_confirmation(callback_query: types.CallbackQuery, st
     failed_count = 0
     
     # Send the message to all users except the admin
-    for recipient_id in user_data.users:
+    for recipient_id in await get_all_users():
         # Skip sending to the admin who initiated the broadcast
         if recipient_id == user_id:
             continue
@@ -1375,7 +1530,7 @@ async def process_broadcast_confirmation(callback_query: types.CallbackQuery, st
             
             # Add a small delay to avoid hitting rate limits
             await asyncio.sleep(0.1)
-            
+        
         except Exception as e:
             logger.error(f"Failed to send broadcast to {recipient_id}: {e}")
             failed_count += 1
@@ -1396,11 +1551,31 @@ async def process_broadcast_confirmation(callback_query: types.CallbackQuery, st
 async def main():
     """Entry point for the bot"""
     # Initialize the database before starting the bot
-    init_db()
+    await init_db()
     
     # Delete webhook before starting polling
     await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if isinstance(test_storage, TestStorage):
+        test_storage.start_write_behind()
+    # The dispatcher closes (and flushes) the FSM storage on shutdown
+    if fsm_storage is not None:
+        fsm_storage.start_write_behind()
+    quiz_timers.start()
+    rearm_restored_quizzes()
+    # Timeout handlers write quiz state, so the timers stop before the dispatcher
+    # closes the FSM storage (its close is the first shutdown handler)
+    dp.shutdown.handlers.insert(0, HandlerObject(callback=quiz_timers.close))
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if isinstance(test_storage, TestStorage):
+            await test_storage.stop_write_behind()
+            # Fold the journal into the snapshot so other readers see every test
+            if test_storage.journal:
+                test_storage.compact()
+        else:
+            test_storage.close()
+        await close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
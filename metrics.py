@@ -0,0 +1,75 @@
+import time
+from collections import defaultdict
+from bisect import bisect_left
+from typing import Dict, List, Sequence
+
+# Upper bounds in seconds; the last bucket catches everything slower
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    """Per-bucket counts plus a running sum, enough for averages and rough percentiles"""
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.total = 0
+        self.sum = 0.0
+    
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += 1
+        self.sum += value
+    
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation (inf if it's in the last one)"""
+        rank = q * self.total
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+    
+    def render(self, name: str) -> List[str]:
+        lines = [f"{name}: count={self.total} avg={self.sum / self.total * 1000:.0f}ms "
+                 f"p50<={self.quantile(0.5)}s p95<={self.quantile(0.95)}s"]
+        labels = [f"<={bound}s" for bound in self.buckets] + [f">{self.buckets[-1]}s"]
+        lines += [f"  {label}: {count}" for label, count in zip(labels, self.counts) if count]
+        return lines
+
+class Metrics:
+    """
+    Process-local counters and latency histograms for the admin /metrics command
+    Counters reset on restart; they are meant for spotting trends, not accounting
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.histograms: Dict[str, Histogram] = {}
+    
+    def increment(self, name: str, value: int = 1) -> None:
+        self.counters[name] += value
+    
+    def get(self, name: str) -> int:
+        return self.counters.get(name, 0)
+    
+    def observe(self, name: str, seconds: float) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+    
+    def render(self) -> str:
+        """Plain text report, one counter per line followed by the histograms"""
+        uptime = int(time.time() - self.started_at)
+        lines = [f"uptime: {uptime // 3600}h {uptime // 60 % 60}m"]
+        lines += [f"{name}: {value}" for name, value in sorted(self.counters.items())]
+        
+        questions = self.get("quiz_questions_sent")
+        if questions:
+            requests = self.get("quiz_requests")
+            lines.append(f"quiz requests per question: {requests / questions:.2f}")
+        for name, histogram in sorted(self.histograms.items()):
+            lines += histogram.render(name)
+        return "\n".join(lines)
+
+metrics = Metrics()
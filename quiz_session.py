@@ -0,0 +1,140 @@
+import base64
+import random
+from collections import OrderedDict
+from typing import Dict, List, Mapping, Any, Optional, Sequence, Tuple
+
+from quiz_utils import unpack_question_order
+
+MAX_QUESTION_LENGTH = 300  # Telegram poll limits
+MAX_OPTION_LENGTH = 100
+
+_PAD = 255
+
+def _truncate(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit-3] + "..."
+
+def build_answer_plan(option_counts: Sequence[int], shuffle: bool) -> str:
+    """
+    Choose the option order of every question up front
+    Each question gets a permutation of its option indexes (the correct answer is
+    option 0), padded to a common stride; packed as base64 for FSM state:
+        stride byte, then `stride` bytes per question
+    """
+    stride = max(option_counts, default=0)
+    if stride >= _PAD:
+        raise ValueError(f"Too many options ({stride}) for an answer plan")
+    packed = bytearray([stride])
+    for count in option_counts:
+        order = list(range(count))
+        if shuffle:
+            # Shuffle the wrong answers, then put the correct one at a random position
+            order = order[1:]
+            random.shuffle(order)
+            order.insert(random.randint(0, len(order)), 0)
+        packed += bytes(order)
+        packed += bytes([_PAD]) * (stride - count)
+    return base64.b64encode(packed).decode('ascii')
+
+def unpack_answer_plan(plan: str) -> List[Tuple[int, ...]]:
+    raw = base64.b64decode(plan)
+    stride = raw[0]
+    if not stride:
+        return []
+    return [
+        tuple(index for index in raw[offset:offset + stride] if index != _PAD)
+        for offset in range(1, len(raw), stride)
+    ]
+
+class QuizSession:
+    """
+    Ready-to-send polls for one quiz run, computed once when the quiz starts
+    polls[position] = (question text, option texts, correct option id)
+    Only test_id, question_order and answer_plan live in FSM state; the session
+    itself can be rebuilt from them, e.g. after a restart
+    The Bot API requests of the next question are built while the current one is
+    open (see prefetch), so an answer only has to send them
+    """
+    __slots__ = ("test_id", "answer_plan", "polls", "_prefetched")
+    
+    def __init__(self, test: Mapping[str, Any], question_order: str, answer_plan: str,
+                 question_format: Optional[str] = None):
+        """question_format: e.g. "[{current}/{total}] {question}" to put the counter in the poll"""
+        self.test_id = test["id"]
+        self.answer_plan = answer_plan
+        self._prefetched: Optional[Tuple[int, list]] = None
+        questions = test["questions"]
+        indexes = unpack_question_order(question_order)
+        total = len(indexes)
+        self.polls = []
+        for position, (index, order) in enumerate(zip(indexes, unpack_answer_plan(answer_plan))):
+            question, options = questions[index]
+            if question_format:
+                question = question_format.format(current=position + 1, total=total, question=question)
+            self.polls.append((
+                _truncate(question, MAX_QUESTION_LENGTH),
+                tuple(_truncate(options[i], MAX_OPTION_LENGTH) for i in order),
+                order.index(0)
+            ))
+    
+    @classmethod
+    def start(cls, test: Mapping[str, Any], question_order: str, shuffle_answers: bool,
+              question_format: Optional[str] = None) -> "QuizSession":
+        """Plan a new quiz run: pick every question's answer order"""
+        questions = test["questions"]
+        option_counts = [len(questions[index][1]) for index in unpack_question_order(question_order)]
+        answer_plan = build_answer_plan(option_counts, shuffle_answers)
+        return cls(test, question_order, answer_plan, question_format)
+    
+    def __len__(self) -> int:
+        return len(self.polls)
+    
+    def prefetch(self, position: int, requests: list) -> None:
+        """Keep the ready-made requests of the question at `position`"""
+        self._prefetched = (position, requests)
+    
+    def take_prefetched(self, position: int) -> Optional[list]:
+        """The prefetched requests if they are for `position`, at most once"""
+        prefetched, self._prefetched = self._prefetched, None
+        if prefetched is not None and prefetched[0] == position:
+            return prefetched[1]
+        return None
+
+class PollIndex:
+    """
+    Maps the poll_id of every sent quiz poll to (user_id, question position, correct option id)
+    Answers are checked against the poll they belong to, so a late answer to an
+    earlier question can be recognised without reading FSM state
+    Polls are dropped when their session ends, or oldest first beyond `max_polls`
+    """
+    def __init__(self, max_polls: int = 100000):
+        self.max_polls = max_polls
+        self._polls: "OrderedDict[str, Tuple[int, int, int]]" = OrderedDict()
+        self._by_user: Dict[int, List[str]] = {}
+    
+    def __len__(self) -> int:
+        return len(self._polls)
+    
+    def add(self, poll_id: str, user_id: int, position: int, correct_option_id: int) -> None:
+        self._polls[poll_id] = (user_id, position, correct_option_id)
+        self._by_user.setdefault(user_id, []).append(poll_id)
+        while len(self._polls) > self.max_polls:
+            old_poll_id, (old_user_id, _, _) = self._polls.popitem(last=False)
+            user_polls = self._by_user[old_user_id]
+            user_polls.remove(old_poll_id)
+            if not user_polls:
+                del self._by_user[old_user_id]
+    
+    def get(self, poll_id: str) -> Optional[Tuple[int, int, int]]:
+        return self._polls.get(poll_id)
+    
+    def is_latest(self, poll_id: str, user_id: int) -> bool:
+        """True if poll_id is the last poll sent to the user, i.e. the open question"""
+        user_polls = self._by_user.get(user_id)
+        return bool(user_polls) and user_polls[-1] == poll_id
+    
+    def has_polls(self, user_id: int) -> bool:
+        return user_id in self._by_user
+    
+    def end_session(self, user_id: int) -> None:
+        for poll_id in self._by_user.pop(user_id, ()):
+            self._polls.pop(poll_id, None)
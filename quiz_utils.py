@@ -2,6 +2,8 @@ from docx import Document
 import random
 import os
 import logging
+import base64
+import struct
 
 logger = logging.getLogger(__name__)
 
@@ -155,6 +157,25 @@ def parse_text_file(file_content):
     """
     return convert_format(file_content, file_type="txt")
 
+def pack_question_order(indexes):
+    """
+    Pack a question order (list of question indexes) into a short string for FSM state
+    4 bytes per question, base64 so it stays JSON serializable
+    """
+    return base64.b64encode(struct.pack(f"<{len(indexes)}I", *indexes)).decode('ascii')
+
+def unpack_question_order(packed):
+    """All question indexes of a packed question order"""
+    raw = base64.b64decode(packed)
+    return list(struct.unpack(f"<{len(raw) // 4}I", raw))
+
+def make_question_order(start, end, shuffle=False):
+    """Packed order of question indexes start..end-1, optionally shuffled"""
+    indexes = list(range(start, end))
+    if shuffle:
+        random.shuffle(indexes)
+    return pack_question_order(indexes)
+
 def calculate_points(correct, total, system=100):
     """
     Calculate points based on scoring system
@@ -0,0 +1,99 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+class TimeoutScheduler:
+    """
+    Any number of timeouts driven by one asyncio task
+    Deadlines sit in a heap; the task sleeps until the earliest one (or until an
+    earlier deadline is scheduled) and calls `on_expire(key, token)` for each
+    expired key in its own short-lived task
+    Every key has at most one live timeout: scheduling again replaces it and
+    cancel() forgets it, both in O(1); the old heap entries are skipped when they
+    come up and dropped in bulk once they outnumber the live ones
+    """
+    def __init__(self, on_expire: Callable[[Hashable, Any], Awaitable[None]]):
+        self.on_expire = on_expire
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        # key -> (sequence number of its live heap entry, token)
+        self._live: Dict[Hashable, Tuple[int, Any]] = {}
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._callbacks: Set[asyncio.Task] = set()
+    
+    def __len__(self) -> int:
+        return len(self._live)
+    
+    def schedule(self, key: Hashable, delay: float, token: Any = None) -> None:
+        """(Re)start the timeout of `key`; `token` is passed back to on_expire"""
+        sequence = next(self._sequence)
+        self._live[key] = (sequence, token)
+        heapq.heappush(self._heap, (time.monotonic() + delay, sequence, key))
+        if self._heap[0][1] == sequence:
+            # New earliest deadline, the timer task has to wake up sooner
+            self._wakeup.set()
+        if len(self._heap) > 2 * len(self._live) + 1024:
+            self._compact()
+    
+    def cancel(self, key: Hashable) -> None:
+        self._live.pop(key, None)
+    
+    def is_scheduled(self, key: Hashable) -> bool:
+        return key in self._live
+    
+    def _compact(self) -> None:
+        """Drop heap entries of cancelled or rescheduled keys"""
+        live = self._live
+        self._heap = [entry for entry in self._heap if live.get(entry[2], (None,))[0] == entry[1]]
+        heapq.heapify(self._heap)
+    
+    def _pop_expired(self, now: float) -> List[Tuple[Hashable, Any]]:
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, sequence, key = heapq.heappop(self._heap)
+            live = self._live.get(key)
+            if live is not None and live[0] == sequence:
+                del self._live[key]
+                expired.append((key, live[1]))
+        return expired
+    
+    def start(self) -> None:
+        """Start the timer task, must be called from the running event loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self) -> None:
+        while True:
+            for key, token in self._pop_expired(time.monotonic()):
+                callback = asyncio.create_task(self._expire(key, token))
+                self._callbacks.add(callback)
+                callback.add_done_callback(self._callbacks.discard)
+            
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _expire(self, key: Hashable, token: Any) -> None:
+        try:
+            await self.on_expire(key, token)
+        except Exception as e:
+            logging.error(f"Error handling timeout {key}: {e}")
+    
+    async def close(self) -> None:
+        """Stop the timer task and wait for running timeout handlers"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._callbacks:
+            await asyncio.gather(*self._callbacks, return_exceptions=True)
@@ -0,0 +1,353 @@
+import json
+import sqlite3
+import logging
+import sys
+from datetime import datetime
+from typing import Dict, List, Tuple, Optional, Any, Mapping
+
+from storage import TestStorage, question_hash, build_test_view
+from cache import LRUCache
+
+def _estimate_tests_size(tests: List[Dict[str, Any]]) -> int:
+    """Rough memory footprint of a user's test list in bytes"""
+    size = 0
+    for test in tests:
+        size += 200 + len(test["name"])
+        for q in test["questions"]:
+            size += 150 + len(q["question"]) + sum(60 + len(option) for option in q["options"])
+    return size
+
+def _estimate_entry_size(entry: Tuple[List[Dict[str, Any]], Dict[int, Dict[str, Any]], Dict[int, Mapping[str, Any]]]) -> int:
+    """Rough footprint of a cached user: the tests plus the views built from them"""
+    tests, _, views = entry
+    # Views share the strings with the tests, only the tuples and the mapping are new
+    size = _estimate_tests_size(tests)
+    for view in views.values():
+        size += 300 + sum(120 + 8 * len(options) for _, options in view["questions"])
+    return size
+
+# Bumped whenever _init_schema learns a new migration (stored in PRAGMA user_version)
+SCHEMA_VERSION = 2
+
+class SQLiteTestStorage:
+    """
+    Test storage backed by indexed SQLite tables
+    Drop-in replacement for TestStorage: only the requested user's rows are read,
+    so memory use does not grow with the number of stored tests
+    
+    A user's test list is loaded the first time it is needed and kept in an LRU
+    cache limited to `cache_budget` bytes, so idle users' questions get evicted
+    together with their id index and cached test views
+    
+    Questions live once in question_pool keyed by content hash; tests reference
+    them through test_questions and triggers keep the pool's reference counts
+    
+    Like TestStorage, test ids are per user (tests.user_test_id) and never reused:
+    user_test_ids holds each user's next id, and its row for user 0 is a floor for
+    everyone above the global ids that the first schema handed out
+    """
+    def __init__(self, db_path: str = "user_tests.db", cache_budget: int = 32 * 1024 * 1024):
+        self.db_path = db_path
+        # user_id -> (tests, {test id: test}, {test id: build_test_view()})
+        self._cache = LRUCache(max_bytes=cache_budget, sizeof=_estimate_entry_size)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self._init_schema()
+    
+    def _init_schema(self) -> None:
+        """Create tables and indexes if they don't exist"""
+        with self.conn:
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS tests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                user_test_id INTEGER,
+                name TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                UNIQUE (user_id, name)
+            )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_tests_user ON tests (user_id, id)')
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_test_ids (
+                user_id INTEGER PRIMARY KEY,
+                next_id INTEGER NOT NULL
+            )
+            ''')
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS question_pool (
+                hash TEXT PRIMARY KEY,
+                question TEXT NOT NULL,
+                options TEXT NOT NULL,
+                refs INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+            ''')
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS test_questions (
+                test_id INTEGER NOT NULL REFERENCES tests(id) ON DELETE CASCADE,
+                position INTEGER NOT NULL,
+                question_hash TEXT NOT NULL,
+                PRIMARY KEY (test_id, position)
+            ) WITHOUT ROWID
+            ''')
+            # Cascading deletes from tests fire these too, so reclaiming needs no extra code
+            self.conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS test_questions_ref AFTER INSERT ON test_questions
+            BEGIN
+                UPDATE question_pool SET refs = refs + 1 WHERE hash = NEW.question_hash;
+            END
+            ''')
+            self.conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS test_questions_unref AFTER DELETE ON test_questions
+            BEGIN
+                UPDATE question_pool SET refs = refs - 1 WHERE hash = OLD.question_hash;
+                DELETE FROM question_pool WHERE hash = OLD.question_hash AND refs <= 0;
+            END
+            ''')
+            
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                self._migrate_inline_questions()
+            if version < 2:
+                self._migrate_user_test_ids()
+            self.conn.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS idx_tests_user_test_id ON tests (user_id, user_test_id)'
+            )
+            self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    
+    def _migrate_inline_questions(self) -> None:
+        """Move questions stored per test (first schema) into the shared pool"""
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'questions'"
+        ).fetchone()
+        if not exists:
+            return
+        
+        rows = self.conn.execute(
+            'SELECT test_id, position, question, options FROM questions ORDER BY test_id, position'
+        ).fetchall()
+        for test_id, position, question, options in rows:
+            key = self._pool_question(question, json.loads(options))
+            self.conn.execute(
+                'INSERT INTO test_questions (test_id, position, question_hash) VALUES (?, ?, ?)',
+                (test_id, position, key)
+            )
+        self.conn.execute('DROP TABLE questions')
+        logging.info(f"Moved {len(rows)} questions into the shared question pool")
+    
+    def _migrate_user_test_ids(self) -> None:
+        """Give tests per-user ids, keeping the global ids that sent buttons already carry"""
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(tests)')]
+        if 'user_test_id' not in columns:
+            self.conn.execute('ALTER TABLE tests ADD COLUMN user_test_id INTEGER')
+        self.conn.execute('UPDATE tests SET user_test_id = id WHERE user_test_id IS NULL')
+        # Any user may hold buttons with global ids up to the last one handed out
+        row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'tests'").fetchone()
+        if row:
+            self._reserve_id(0, row[0])
+    
+    def _reserve_id(self, user_id: int, test_id: int) -> None:
+        """Make sure ids up to test_id are never handed out to the user again"""
+        self.conn.execute('''
+        INSERT INTO user_test_ids (user_id, next_id) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET next_id = MAX(next_id, excluded.next_id)
+        ''', (user_id, test_id + 1))
+    
+    def _allocate_id(self, user_id: int) -> int:
+        """Take the user's next test id"""
+        test_id = self.conn.execute('''
+        SELECT MAX(COALESCE((SELECT next_id FROM user_test_ids WHERE user_id = ?), 1),
+                   COALESCE((SELECT next_id FROM user_test_ids WHERE user_id = 0), 1))
+        ''', (user_id,)).fetchone()[0]
+        self._reserve_id(user_id, test_id)
+        return test_id
+    
+    def _pool_question(self, question: str, options: List[str]) -> str:
+        """Make sure a question is in the pool and return its hash"""
+        key = question_hash(question, options)
+        self.conn.execute(
+            'INSERT OR IGNORE INTO question_pool (hash, question, options) VALUES (?, ?, ?)',
+            (key, question, json.dumps(options, ensure_ascii=False))
+        )
+        return key
+    
+    def close(self) -> None:
+        self.conn.close()
+    
+    def _put_test(self, user_id: int, test_name: str, questions: List[Tuple[str, List[str]]],
+                  created_at: str, updated_at: str, user_test_id: Optional[int] = None) -> int:
+        """
+        Insert or replace a test by (user_id, name) inside the current transaction
+        user_test_id: id for a new test (used when migrating), unless the user already has it
+        Returns the test's per-user id, which stays the same when a test is replaced
+        """
+        existing = self.conn.execute(
+            'SELECT id, user_test_id FROM tests WHERE user_id = ? AND name = ?', (user_id, test_name)
+        ).fetchone()
+        if existing is not None:
+            row_id, user_test_id = existing
+            self.conn.execute('UPDATE tests SET updated_at = ? WHERE id = ?', (updated_at, row_id))
+        else:
+            taken = user_test_id is not None and self.conn.execute(
+                'SELECT 1 FROM tests WHERE user_id = ? AND user_test_id = ?', (user_id, user_test_id)
+            ).fetchone() is not None
+            if user_test_id is None or taken:
+                user_test_id = self._allocate_id(user_id)
+            else:
+                self._reserve_id(user_id, user_test_id)
+            row_id = self.conn.execute(
+                'INSERT INTO tests (user_id, user_test_id, name, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (user_id, user_test_id, test_name, created_at, updated_at)
+            ).lastrowid
+        
+        # Release the old references first, otherwise still-unreferenced pool rows would be dropped
+        self.conn.execute('DELETE FROM test_questions WHERE test_id = ?', (row_id,))
+        for position, (question, options) in enumerate(questions):
+            key = self._pool_question(question, options)
+            self.conn.execute(
+                'INSERT INTO test_questions (test_id, position, question_hash) VALUES (?, ?, ?)',
+                (row_id, position, key)
+            )
+        return user_test_id
+    
+    def _load_questions(self, test_id: int) -> List[Dict[str, Any]]:
+        rows = self.conn.execute('''
+        SELECT p.question, p.options
+        FROM test_questions tq JOIN question_pool p ON p.hash = tq.question_hash
+        WHERE tq.test_id = ?
+        ORDER BY tq.position
+        ''', (test_id,))
+        return [{"question": question, "options": json.loads(options)} for question, options in rows]
+    
+    def add_test(self, user_id: int, test_name: str, questions: List[Tuple[str, List[str]]]) -> Optional[int]:
+        """
+        Add a new test for a user
+        An existing test with the same name is replaced, keeping its id and creation date
+        Returns the test id, or None if it could not be saved
+        """
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        test_id = None
+        try:
+            with self.conn:
+                test_id = self._put_test(user_id, test_name, questions, now, now)
+        except Exception as e:
+            logging.error(f"Error saving test: {e}")
+        self._cache.pop(user_id)
+        return test_id
+    
+    def _load_user(self, user_id: int) -> Tuple[List[Dict[str, Any]], Dict[int, Dict[str, Any]], Dict[int, Mapping[str, Any]]]:
+        """Return the user's tests, their id index and view cache, reading them on first use"""
+        entry = self._cache.get(user_id)
+        if entry is None:
+            rows = self.conn.execute(
+                'SELECT id, user_test_id, name, created_at, updated_at FROM tests WHERE user_id = ? ORDER BY id',
+                (user_id,)
+            ).fetchall()
+            tests = [{
+                "id": test_id,
+                "name": name,
+                "questions": self._load_questions(row_id),
+                "created_at": created_at,
+                "updated_at": updated_at
+            } for row_id, test_id, name, created_at, updated_at in rows]
+            entry = (tests, {test["id"]: test for test in tests}, {})
+            self._cache.put(user_id, entry)
+        return entry
+    
+    def get_user_tests(self, user_id: int) -> List[Dict[str, Any]]:
+        """
+        Get all tests for a user
+        Each user only sees their own tests, even admins
+        """
+        return self._load_user(user_id)[0]
+    
+    def get_test(self, user_id: int, test_index: int) -> Optional[Mapping[str, Any]]:
+        """
+        Get a specific test by index
+        Returns a shared read-only view, see build_test_view()
+        """
+        tests = self.get_user_tests(user_id)
+        if test_index < 0 or test_index >= len(tests):
+            return None
+        return self.get_test_by_id(user_id, tests[test_index]["id"])
+    
+    def get_test_by_id(self, user_id: int, test_id: int) -> Optional[Mapping[str, Any]]:
+        """
+        Get a specific test by its stable id
+        Returns a shared read-only view, see build_test_view()
+        """
+        entry = self._load_user(user_id)
+        _, by_id, views = entry
+        view = views.get(test_id)
+        if view is None:
+            test = by_id.get(test_id)
+            if test is None:
+                return None
+            view = views[test_id] = build_test_view(test)
+            # The entry grew, put it again so the cache budget accounts for the view
+            self._cache.put(user_id, entry)
+        return view
+    
+    def delete_test(self, user_id: int, test_index: int) -> bool:
+        """Delete a test by index"""
+        tests = self.get_user_tests(user_id)
+        if test_index < 0 or test_index >= len(tests):
+            return False
+        return self.delete_test_by_id(user_id, tests[test_index]["id"])
+    
+    def delete_test_by_id(self, user_id: int, test_id: int) -> bool:
+        """Delete a test by its stable id"""
+        deleted = 0
+        try:
+            with self.conn:
+                deleted = self.conn.execute(
+                    'DELETE FROM tests WHERE user_test_id = ? AND user_id = ?', (test_id, user_id)
+                ).rowcount
+        except Exception as e:
+            logging.error(f"Error deleting test: {e}")
+        self._cache.pop(user_id)
+        return deleted > 0
+    
+    def count_tests(self) -> int:
+        """Count tests across all users"""
+        return self.conn.execute('SELECT COUNT(*) FROM tests').fetchone()[0]
+
+def migrate_from_json(json_path: str = "user_tests.json", db_path: str = "user_tests.db") -> int:
+    """
+    Copy every test from the JSON store (snapshot plus journal) into SQLite
+    Tests are upserted by name, so running it again is harmless
+    Tests keep their ids, so buttons the bot already sent still open the same test
+    Returns the number of migrated tests
+    """
+    source = TestStorage(json_path, journal=True)
+    target = SQLiteTestStorage(db_path)
+    migrated = 0
+    try:
+        with target.conn:
+            for user_id_str, tests in source.tests.items():
+                for test in tests:
+                    questions = [(q["question"], q["options"]) for q in test["questions"]]
+                    target._put_test(
+                        int(user_id_str),
+                        test["name"],
+                        questions,
+                        test.get("created_at", ""),
+                        test.get("updated_at", test.get("created_at", "")),
+                        user_test_id=test["id"]
+                    )
+                    migrated += 1
+            # Ids of tests deleted before the move stay retired
+            for user_id_str, next_id in source._next_ids.items():
+                target._reserve_id(int(user_id_str), next_id - 1)
+    finally:
+        target.close()
+    
+    logging.info(f"Migrated {migrated} tests from {json_path} to {db_path}")
+    return migrated
+
+if __name__ == "__main__":
+    # python sqlite_storage.py [user_tests.json] [user_tests.db]
+    logging.basicConfig(level=logging.INFO)
+    migrate_from_json(*sys.argv[1:3])
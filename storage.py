@@ -1,47 +1,443 @@
+import asyncio
+import hashlib
 import json
 import os
 import logging
+import threading
 from datetime import datetime
-from typing import Dict, List, Tuple, Optional, Any
+from types import MappingProxyType
+from typing import Dict, List, Tuple, Optional, Any, Mapping
+
+from storage_format import encode_snapshot, decode_snapshot, is_binary
+from cache import LRUCache
+
+# Snapshot layout with interned questions:
+# {"version": 2, "questions": {hash: question}, "tests": {user: [test]}, "next_ids": {user: next test id}}
+SNAPSHOT_VERSION = 2
+
+def question_hash(question: str, options: List[str]) -> str:
+    """Content hash identifying a question together with its options"""
+    payload = json.dumps([question, options], ensure_ascii=False).encode('utf-8')
+    return hashlib.blake2b(payload, digest_size=10).hexdigest()
+
+def build_test_view(test: Dict[str, Any]) -> Mapping[str, Any]:
+    """
+    Read-only view of a stored test in the format the bot uses
+    questions is a tuple of (question, (answers)) tuples, safe to share between handlers
+    """
+    return MappingProxyType({
+        "id": test["id"],
+        "name": test["name"],
+        "questions": tuple((q["question"], tuple(q["options"])) for q in test["questions"]),
+        "created_at": test["created_at"]
+    })
 
 class TestStorage:
     """
     Class for storing and managing user tests
+    
+    In journal mode every change is appended to `<storage_path>.journal` as a
+    single JSON line instead of rewriting the whole file. Once the journal grows
+    past `compact_threshold` records a background thread folds it back into the
+    snapshot. On startup the snapshot is loaded and the journal replayed on top.
+    
+    In write-behind mode changes are only queued in memory; a background task
+    calls flush() every `flush_interval` seconds to write the whole batch from a
+    worker thread, so handlers never wait for the disk. Call stop_write_behind()
+    on shutdown to write out whatever is still queued.
+    
+    Snapshots are written to a temp file, fsynced and renamed over the old one,
+    which is kept as `<storage_path>.1` ... `.N` for the last `generations` saves.
+    If the newest snapshot is unreadable, loading falls back to older generations.
+    With snapshot_format="binary" snapshots use the packed layout from
+    storage_format; either format is recognised when loading.
+    
+    Questions are interned by content hash: identical questions in different tests
+    share one record in memory and on disk, and are reclaimed once no test uses them.
+    
+    Every test has an `id` that is unique per user and never changes, so callers can
+    keep referring to a test after others are deleted. Per-user indexes by id and by
+    name make lookups and upserts constant time. get_test_by_id returns a cached
+    read-only view that is rebuilt only after the test changes.
     """
-    def __init__(self, storage_path: str = "user_tests.json"):
+    def __init__(self, storage_path: str = "user_tests.json", journal: bool = False,
+                 compact_threshold: int = 200, write_behind: bool = False,
+                 flush_interval: float = 2.0, generations: int = 3,
+                 snapshot_format: str = "json"):
         self.storage_path = storage_path
+        self.journal = journal
+        self.journal_path = f"{storage_path}.journal"
+        self.compact_threshold = compact_threshold
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.generations = generations
+        self.snapshot_format = snapshot_format
+        self._snapshot_lock = threading.Lock()
+        self._compaction_lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._pending: List[Dict[str, Any]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._journal_records = 0
+        self._compaction_thread: Optional[threading.Thread] = None
+        self._questions: Dict[str, Dict[str, Any]] = {}  # hash -> shared question record
+        self._refcounts: Dict[str, int] = {}
+        self._hash_by_id: Dict[int, str] = {}  # id(shared record) -> hash, avoids rehashing
+        self._by_id: Dict[str, Dict[int, Dict[str, Any]]] = {}  # user -> test id -> test
+        self._by_name: Dict[str, Dict[str, Dict[str, Any]]] = {}  # user -> test name -> test
+        self._next_ids: Dict[str, int] = {}
+        self._views = LRUCache(max_items=256)  # (user, test id) -> build_test_view()
         self.tests = self._load_tests()
+        self._build_indexes()
+        if self.journal:
+            self._replay_journal()
+    
+    def _generation_path(self, generation: int) -> str:
+        return self.storage_path if generation == 0 else f"{self.storage_path}.{generation}"
     
     def _load_tests(self) -> Dict[str, List[Dict[str, Any]]]:
-        """Load tests from file or create empty structure"""
-        if os.path.exists(self.storage_path):
+        """Load tests from the newest readable snapshot or create empty structure"""
+        for generation in range(self.generations + 1):
+            path = self._generation_path(generation)
+            if not os.path.exists(path):
+                continue
             try:
-                with open(self.storage_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                with open(path, 'rb') as f:
+                    raw = f.read()
+                if is_binary(raw):
+                    snapshot = decode_snapshot(raw)
+                else:
+                    snapshot = json.loads(raw.decode('utf-8'))
+                    if snapshot.get("version") != SNAPSHOT_VERSION:
+                        # Legacy layout: {user: [test]} with full question copies
+                        snapshot = {"questions": None, "tests": snapshot}
+                # Drop anything interned by a failed attempt on a newer generation
+                self._questions.clear()
+                self._refcounts.clear()
+                self._hash_by_id.clear()
+                tests = self._deserialize(snapshot["questions"], snapshot["tests"])
+                # Snapshots written before the counters were saved fall back to max(id) + 1
+                self._next_ids = {user_id_str: int(next_id) for user_id_str, next_id in snapshot.get("next_ids", {}).items()}
+                if generation:
+                    logging.warning(f"Loaded tests from older snapshot {path}")
+                return tests
             except Exception as e:
-                logging.error(f"Error loading tests: {e}")
+                logging.error(f"Error loading tests from {path}: {e}")
         return {}
     
+    def _deserialize(self, pool: Optional[Dict[str, Dict[str, Any]]], tests: Dict[str, List[Dict[str, Any]]]) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Build in-memory tests from a snapshot, interning every question
+        pool: question records by hash as referenced from tests,
+        or None when tests hold full question copies (legacy layout)
+        """
+        for user_tests in tests.values():
+            for test in user_tests:
+                if pool is None:
+                    test["questions"] = [self._intern(q) for q in test["questions"]]
+                else:
+                    test["questions"] = [self._intern(pool[key], key) for key in test["questions"]]
+        return tests
+    
+    def _build_indexes(self) -> None:
+        """
+        Index loaded tests by id and name, giving ids to tests saved before they existed
+        The saved per-user counter wins over max(id) + 1, so ids of deleted tests are never reused
+        """
+        for user_id_str, user_tests in self.tests.items():
+            next_id = max((test.get("id", 0) for test in user_tests), default=0) + 1
+            next_id = max(next_id, self._next_ids.get(user_id_str, 1))
+            for test in user_tests:
+                if "id" not in test:
+                    test["id"] = next_id
+                    next_id += 1
+            self._by_id[user_id_str] = {test["id"]: test for test in user_tests}
+            self._by_name[user_id_str] = {test["name"]: test for test in user_tests}
+            self._next_ids[user_id_str] = next_id
+    
+    def _allocate_id(self, user_id_str: str) -> int:
+        test_id = self._next_ids.get(user_id_str, 1)
+        self._next_ids[user_id_str] = test_id + 1
+        return test_id
+    
+    def _serialize(self) -> Dict[str, Any]:
+        """
+        Snapshot of all tests with questions stored once and referenced by hash
+        Takes its own copies of the containers, so it can be encoded after the lock is
+        released (shared question records are never modified, only replaced)
+        """
+        tests = {}
+        for user_id_str, user_tests in self.tests.items():
+            tests[user_id_str] = [
+                dict(test, questions=[self._hash_of(q) for q in test["questions"]])
+                for test in user_tests
+            ]
+        return {
+            "version": SNAPSHOT_VERSION,
+            "questions": dict(self._questions),
+            "tests": tests,
+            "next_ids": dict(self._next_ids)
+        }
+    
+    def _hash_of(self, question: Dict[str, Any]) -> str:
+        key = self._hash_by_id.get(id(question))
+        if key is None:
+            key = question_hash(question["question"], question["options"])
+        return key
+    
+    def _intern(self, question: Dict[str, Any], key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Return the shared record for a question and take a reference to it
+        key: the question's hash when already known (e.g. from a snapshot)
+        """
+        if key is None:
+            key = self._hash_of(question)
+        shared = self._questions.get(key)
+        if shared is None:
+            shared = {"question": question["question"], "options": question["options"]}
+            self._questions[key] = shared
+            self._refcounts[key] = 0
+            self._hash_by_id[id(shared)] = key
+        self._refcounts[key] += 1
+        return shared
+    
+    def _release(self, questions: List[Dict[str, Any]]) -> None:
+        """Drop references held by a removed test and reclaim unused questions"""
+        for question in questions:
+            key = self._hash_of(question)
+            self._refcounts[key] -= 1
+            if self._refcounts[key] <= 0:
+                del self._refcounts[key]
+                del self._hash_by_id[id(self._questions.pop(key))]
+    
+    def _encode_snapshot(self, snapshot: Optional[Dict[str, Any]] = None) -> bytes:
+        """Encode a snapshot from _serialize() (by default of the current tests) in the configured format"""
+        if snapshot is None:
+            snapshot = self._serialize()
+        if self.snapshot_format == "binary":
+            return encode_snapshot(snapshot)
+        return json.dumps(snapshot, ensure_ascii=False, indent=2).encode('utf-8')
+    
     def _save_tests(self) -> None:
         """Save tests to file"""
         try:
-            with open(self.storage_path, 'w', encoding='utf-8') as f:
-                json.dump(self.tests, f, ensure_ascii=False, indent=2)
+            self._write_snapshot(self._encode_snapshot())
         except Exception as e:
             logging.error(f"Error saving tests: {e}")
     
-    def add_test(self, user_id: int, test_name: str, questions: List[Tuple[str, List[str]]]) -> None:
+    def _write_snapshot(self, data: bytes) -> None:
+        """
+        Atomically replace the snapshot, keeping previous ones as generations
+        The old file is never touched until the new one is fully on disk
+        """
+        tmp_path = f"{self.storage_path}.tmp"
+        with self._snapshot_lock:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            
+            # storage_path -> .1 -> .2 ... the oldest generation is overwritten
+            for generation in range(self.generations, 0, -1):
+                older = self._generation_path(generation - 1)
+                if os.path.exists(older):
+                    os.replace(older, self._generation_path(generation))
+            os.replace(tmp_path, self.storage_path)
+            self._fsync_dir()
+    
+    def _fsync_dir(self) -> None:
+        """Persist the renames themselves (not supported on every platform)"""
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self.storage_path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+    
+    def _replay_journal(self) -> None:
+        """Apply journal records left over from previous runs"""
+        # A journal rotated by an unfinished compaction is older than the live one
+        for path in (f"{self.journal_path}.old", self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line_no, line in enumerate(f, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Only the last record can be torn by a crash mid-append
+                        logging.warning(f"Skipping damaged journal record {path}:{line_no}")
+                        continue
+                    self._apply(record)
+                    self._journal_records += 1
+        if self._journal_records:
+            logging.info(f"Replayed {self._journal_records} journal records")
+    
+    def _apply(self, record: Dict[str, Any]) -> None:
+        """
+        Apply a single change record to the in-memory tests
+        Records are idempotent, so replaying one already in the snapshot is harmless
+        """
+        user_id_str = record["user"]
+        user_tests = self.tests.setdefault(user_id_str, [])
+        by_id = self._by_id.setdefault(user_id_str, {})
+        by_name = self._by_name.setdefault(user_id_str, {})
+        
+        if record["op"] == "put":
+            new_test = dict(record["test"])
+            new_test["questions"] = [self._intern(q) for q in new_test["questions"]]
+            existing = by_name.get(new_test["name"])
+            if existing is not None:
+                # Update in place: the test keeps its position and id
+                self._release(existing["questions"])
+                new_test["id"] = existing["id"]
+                existing.update(new_test)
+                self._views.pop((user_id_str, existing["id"]))
+                return
+            if "id" not in new_test:
+                # Journal records written before tests had ids
+                new_test["id"] = self._allocate_id(user_id_str)
+            self._next_ids[user_id_str] = max(self._next_ids.get(user_id_str, 1), new_test["id"] + 1)
+            user_tests.append(new_test)
+            by_id[new_test["id"]] = new_test
+            by_name[new_test["name"]] = new_test
+        elif record["op"] == "delete":
+            if "id" in record:
+                test = by_id.get(record["id"])
+            else:
+                test = by_name.get(record["name"])
+            if test is None:
+                return
+            del by_id[test["id"]]
+            del by_name[test["name"]]
+            self._views.pop((user_id_str, test["id"]))
+            for i, candidate in enumerate(user_tests):
+                if candidate is test:
+                    user_tests.pop(i)
+                    break
+            self._release(test["questions"])
+    
+    def _persist(self, record: Dict[str, Any]) -> None:
+        """Make an applied change durable"""
+        if self.write_behind:
+            # Written by the next flush()
+            self._pending.append(record)
+            return
+        
+        if not self.journal:
+            self._save_tests()
+            return
+        
+        try:
+            self._append_journal([record])
+        except Exception as e:
+            logging.error(f"Error writing journal: {e}")
+    
+    def _append_journal(self, records: List[Dict[str, Any]]) -> None:
+        """Append records to the journal in a single write"""
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+        
+        self._journal_records += len(records)
+        if self._journal_records >= self.compact_threshold:
+            self._start_compaction()
+    
+    def flush(self) -> None:
+        """Write out every change queued in write-behind mode"""
+        with self._flush_lock:
+            with self._lock:
+                records, self._pending = self._pending, []
+                if not records:
+                    return
+                if not self.journal:
+                    snapshot = self._serialize()
+            
+            try:
+                if self.journal:
+                    self._append_journal(records)
+                else:
+                    # Encoding the whole corpus must not hold up handlers waiting for the lock
+                    self._write_snapshot(self._encode_snapshot(snapshot))
+            except Exception as e:
+                logging.error(f"Error flushing tests: {e}")
+                # Keep the batch for the next attempt
+                with self._lock:
+                    self._pending[:0] = records
+    
+    def start_write_behind(self) -> None:
+        """Start the background flush task, must be called from the running event loop"""
+        if self.write_behind and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self._pending:
+                await asyncio.to_thread(self.flush)
+    
+    async def stop_write_behind(self) -> None:
+        """Stop the background flush task and write out anything still queued"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await asyncio.to_thread(self.flush)
+    
+    def _start_compaction(self) -> None:
+        """Run compact() in a background thread unless one is already running"""
+        if self._compaction_thread and self._compaction_thread.is_alive():
+            return
+        self._compaction_thread = threading.Thread(target=self.compact, name="tests-compaction", daemon=True)
+        self._compaction_thread.start()
+    
+    def compact(self) -> None:
+        """
+        Fold the journal into a fresh snapshot and drop it
+        Compactions run one at a time from encode to journal removal, so an older
+        snapshot can never be written over a newer one (e.g. the shutdown compaction
+        racing a background one)
+        """
+        old_journal_path = f"{self.journal_path}.old"
+        with self._compaction_lock:
+            try:
+                with self._lock:
+                    snapshot = self._serialize()
+                    if os.path.exists(self.journal_path):
+                        if os.path.exists(old_journal_path):
+                            # A previous compaction failed, keep its records in front
+                            with open(self.journal_path, 'r', encoding='utf-8') as src, \
+                                 open(old_journal_path, 'a', encoding='utf-8') as dst:
+                                dst.write(src.read())
+                            os.remove(self.journal_path)
+                        else:
+                            os.replace(self.journal_path, old_journal_path)
+                    self._journal_records = 0
+                
+                self._write_snapshot(self._encode_snapshot(snapshot))
+                if os.path.exists(old_journal_path):
+                    os.remove(old_journal_path)
+                logging.info("Test journal compacted")
+            except Exception as e:
+                logging.error(f"Error compacting tests journal: {e}")
+    
+    def add_test(self, user_id: int, test_name: str, questions: List[Tuple[str, List[str]]]) -> int:
         """
         Add a new test for a user
         user_id: Telegram user ID
         test_name: Name of the test
         questions: List of (question, [answers]) tuples
+        Returns the test id; a test with the same name is replaced and keeps its id
         """
         user_id_str = str(user_id)
         
-        if user_id_str not in self.tests:
-            self.tests[user_id_str] = []
-        
         # Convert questions to a serializable format
         serializable_questions = []
         for question, options in questions:
@@ -50,24 +446,22 @@ class TestStorage:
                 "options": options
             })
         
-        # Check if a test with this name already exists
-        for test in self.tests[user_id_str]:
-            if test["name"] == test_name:
-                # Update existing test
-                test["questions"] = serializable_questions
-                test["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self._save_tests()
-                return
-        
-        # Create new test
-        self.tests[user_id_str].append({
-            "name": test_name,
-            "questions": serializable_questions,
-            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        self._save_tests()
+        with self._lock:
+            existing = self._by_name.get(user_id_str, {}).get(test_name)
+            test = {
+                "id": existing["id"] if existing else self._allocate_id(user_id_str),
+                "name": test_name,
+                "questions": serializable_questions,
+                "created_at": existing["created_at"] if existing else now,
+                "updated_at": now
+            }
+            
+            record = {"op": "put", "user": user_id_str, "test": test}
+            self._apply(record)
+            self._persist(record)
+        return test["id"]
     
     def get_user_tests(self, user_id: int) -> List[Dict[str, Any]]:
         """
@@ -77,34 +471,50 @@ class TestStorage:
         user_id_str = str(user_id)
         return self.tests.get(user_id_str, [])
     
-    def get_test(self, user_id: int, test_index: int) -> Optional[Dict[str, Any]]:
+    def get_test(self, user_id: int, test_index: int) -> Optional[Mapping[str, Any]]:
         """
         Get a specific test by index
-        Returns formatted questions list [(question, [answers])]
+        Returns a shared read-only view, see build_test_view()
         """
-        user_id_str = str(user_id)
-        if user_id_str not in self.tests or test_index >= len(self.tests[user_id_str]):
+        user_tests = self.tests.get(str(user_id), [])
+        if test_index < 0 or test_index >= len(user_tests):
             return None
-        
-        test = self.tests[user_id_str][test_index]
-        
-        # Convert serialized questions to the format expected by the bot
-        questions = []
-        for q in test["questions"]:
-            questions.append((q["question"], q["options"]))
-        
-        return {
-            "name": test["name"],
-            "questions": questions,
-            "created_at": test["created_at"]
-        }
+        return self.get_test_by_id(user_id, user_tests[test_index]["id"])
+    
+    def get_test_by_id(self, user_id: int, test_id: int) -> Optional[Mapping[str, Any]]:
+        """
+        Get a specific test by its stable id
+        Returns a shared read-only view, see build_test_view()
+        """
+        user_id_str = str(user_id)
+        view = self._views.get((user_id_str, test_id))
+        if view is None:
+            test = self._by_id.get(user_id_str, {}).get(test_id)
+            if test is None:
+                return None
+            view = build_test_view(test)
+            self._views.put((user_id_str, test_id), view)
+        return view
     
     def delete_test(self, user_id: int, test_index: int) -> bool:
         """Delete a test by index"""
-        user_id_str = str(user_id)
-        if user_id_str not in self.tests or test_index >= len(self.tests[user_id_str]):
+        user_tests = self.tests.get(str(user_id), [])
+        if test_index < 0 or test_index >= len(user_tests):
             return False
-        
-        self.tests[user_id_str].pop(test_index)
-        self._save_tests()
+        return self.delete_test_by_id(user_id, user_tests[test_index]["id"])
+    
+    def delete_test_by_id(self, user_id: int, test_id: int) -> bool:
+        """Delete a test by its stable id"""
+        user_id_str = str(user_id)
+        with self._lock:
+            if test_id not in self._by_id.get(user_id_str, {}):
+                return False
+            
+            record = {"op": "delete", "user": user_id_str, "id": test_id}
+            self._apply(record)
+            self._persist(record)
         return True
+    
+    def count_tests(self) -> int:
+        """Count tests across all users"""
+        return sum(len(tests) for tests in self.tests.values())
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""
+Compact binary layout for TestStorage snapshots
+
+    header   magic "MQTS", format version, flags, string count, int count, text size
+    ints     uint32 array describing the structure (counts, test ids, question indexes)
+    lengths  uint32 array with the length of every string in characters
+             (omitted when FLAG_NUL_SEPARATED is set)
+    text     all strings concatenated, UTF-8 encoded; NUL separated when flagged
+
+Strings are stored in the order they are read back, so the structure needs no
+string indexes. Loading decodes and splits the text in one go and takes question
+references as array slices, which avoids most of the per-value work json does.
+"""
+import struct
+import sys
+from array import array
+from itertools import accumulate
+from typing import Dict, List, Any
+
+MAGIC = b"MQTS"
+# Version 2 adds the test id in front of each test's question count,
+# version 3 the user's next test id after their test count
+FORMAT_VERSION = 3
+FLAG_NUL_SEPARATED = 1
+
+_HEADER = struct.Struct("<4sBBIII")
+
+def _uint32_array(values=()) -> array:
+    arr = array('I', values)
+    assert arr.itemsize == 4
+    return arr
+
+def is_binary(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+def encode_snapshot(snapshot: Dict[str, Any]) -> bytes:
+    """
+    Pack a snapshot as produced by TestStorage._serialize
+    {"questions": {hash: {"question", "options"}}, "tests": {user: [test with question hashes]},
+     "next_ids": {user: next test id}}
+    """
+    ints = _uint32_array()
+    strings: List[str] = []
+    
+    index_of = {}
+    ints.append(len(snapshot["questions"]))
+    for index, (key, question) in enumerate(snapshot["questions"].items()):
+        index_of[key] = index
+        strings.append(key)
+        strings.append(question["question"])
+        strings.extend(question["options"])
+        ints.append(len(question["options"]))
+    
+    next_ids = snapshot.get("next_ids", {})
+    ints.append(len(snapshot["tests"]))
+    for user_id_str, tests in snapshot["tests"].items():
+        strings.append(user_id_str)
+        ints.append(len(tests))
+        ints.append(next_ids.get(user_id_str, max((test["id"] for test in tests), default=0) + 1))
+        for test in tests:
+            strings.append(test["name"])
+            strings.append(test.get("created_at", ""))
+            strings.append(test.get("updated_at", ""))
+            ints.append(test["id"])
+            ints.append(len(test["questions"]))
+            ints.extend(index_of[key] for key in test["questions"])
+    
+    text = "\0".join(strings)
+    if text.count("\0") == len(strings) - 1:
+        flags = FLAG_NUL_SEPARATED
+        lengths = _uint32_array()
+    else:
+        # Some string contains NUL itself, fall back to explicit lengths
+        flags = 0
+        text = "".join(strings)
+        lengths = _uint32_array(len(s) for s in strings)
+    
+    if sys.byteorder == 'big':
+        ints.byteswap()
+        lengths.byteswap()
+    
+    data = text.encode('utf-8')
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, flags, len(strings), len(ints), len(data))
+    return b"".join((header, ints.tobytes(), lengths.tobytes(), data))
+
+def decode_snapshot(data: bytes) -> Dict[str, Any]:
+    """Unpack a binary snapshot into the TestStorage snapshot layout"""
+    magic, version, flags, string_count, int_count, text_size = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a binary test snapshot")
+    if version not in (1, 2, FORMAT_VERSION):
+        raise ValueError(f"Unsupported binary snapshot version {version}")
+    
+    offset = _HEADER.size
+    ints = _uint32_array()
+    ints.frombytes(data[offset:offset + int_count * 4])
+    offset += int_count * 4
+    lengths = _uint32_array()
+    if not flags & FLAG_NUL_SEPARATED:
+        lengths.frombytes(data[offset:offset + string_count * 4])
+        offset += string_count * 4
+    if sys.byteorder == 'big':
+        ints.byteswap()
+        lengths.byteswap()
+    
+    text = data[offset:offset + text_size].decode('utf-8')
+    if flags & FLAG_NUL_SEPARATED:
+        strings = text.split("\0") if string_count else []
+    else:
+        ends = list(accumulate(lengths))
+        strings = [text[end - length:end] for end, length in zip(ends, lengths)]
+    if len(ints) != int_count or len(strings) != string_count:
+        raise ValueError("Binary snapshot is truncated")
+    
+    ints = ints.tolist()
+    i = s = 0  # positions in ints and strings
+    
+    keys = []
+    questions = {}
+    question_count = ints[i]
+    i += 1
+    for _ in range(question_count):
+        option_count = ints[i]
+        i += 1
+        key = strings[s]
+        keys.append(key)
+        questions[key] = {"question": strings[s + 1], "options": strings[s + 2:s + 2 + option_count]}
+        s += 2 + option_count
+    
+    tests = {}
+    next_ids = {}
+    user_count = ints[i]
+    i += 1
+    for _ in range(user_count):
+        user_tests = tests[strings[s]] = []
+        test_count = ints[i]
+        s += 1
+        i += 1
+        if version >= 3:
+            next_ids[strings[s - 1]] = ints[i]
+            i += 1
+        for _ in range(test_count):
+            test = {}
+            if version >= 2:
+                test["id"] = ints[i]
+                i += 1
+            ref_count = ints[i]
+            i += 1
+            test.update({
+                "name": strings[s],
+                "questions": [keys[ref] for ref in ints[i:i + ref_count]],
+                "created_at": strings[s + 1],
+                "updated_at": strings[s + 2]
+            })
+            user_tests.append(test)
+            s += 3
+            i += ref_count
+    
+    return {"questions": questions, "tests": tests, "next_ids": next_ids}
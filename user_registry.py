@@ -0,0 +1,88 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import async_database
+from cache import LRUCache, IntByteMap
+
+class UserRegistry:
+    """
+    Registered users and their quiz history, stored in the bot_users.db users and
+    test_results tables
+    Profiles and results are read through a bounded LRU cache and written through
+    to the database, so lookups stay in memory without holding every user forever
+    
+    Languages are asked for on almost every message, so they get their own compact
+    read-through cache: user id -> index into `languages`, or NO_LANGUAGE
+    """
+    NO_LANGUAGE = 254
+    
+    def __init__(self, languages: Tuple[str, ...], cache_size: int = 10000):
+        # user_id -> {"username", "full_name", "joined_date", "test_results": list or None}
+        self._cache = LRUCache(max_items=cache_size)
+        self.languages = tuple(languages)
+        self._language_codes = {lang: code for code, lang in enumerate(self.languages)}
+        self._language_cache = IntByteMap()
+        self.total_quizzes = 0
+    
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Return a user's profile, or None if they never sent /start"""
+        profile = self._cache.get(user_id)
+        if profile is None:
+            profile = await async_database.get_user_profile(user_id)
+            if profile is None:
+                return None
+            profile["test_results"] = None  # loaded on first use
+            self._cache.put(user_id, profile)
+        return profile
+    
+    async def exists(self, user_id: int) -> bool:
+        return await self.get(user_id) is not None
+    
+    async def register(self, user_id: int, username: Optional[str], first_name: Optional[str],
+                       last_name: Optional[str], full_name: Optional[str]) -> None:
+        """Add a user or refresh their name"""
+        await async_database.add_user(
+            user_id=user_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+            full_name=full_name
+        )
+        profile = self._cache.get(user_id)
+        if profile is not None:
+            profile["username"] = username
+            profile["full_name"] = full_name
+    
+    async def get_results(self, user_id: int) -> List[Dict[str, Any]]:
+        profile = await self.get(user_id)
+        if profile is None:
+            return await async_database.get_test_results(user_id)
+        if profile["test_results"] is None:
+            profile["test_results"] = await async_database.get_test_results(user_id)
+        return profile["test_results"]
+    
+    async def add_result(self, user_id: int, result: Dict[str, Any]) -> None:
+        await async_database.add_test_result(user_id, result)
+        profile = self._cache.get(user_id)
+        if profile is not None and profile["test_results"] is not None:
+            profile["test_results"].append(result)
+    
+    async def count(self) -> int:
+        return await async_database.count_users()
+    
+    async def all_profiles(self) -> List[Tuple[int, Dict[str, Any]]]:
+        """(user_id, profile) for every user, read straight from the database"""
+        return await async_database.get_user_profiles()
+    
+    async def get_language(self, user_id: int) -> Optional[str]:
+        """The user's chosen language, or None if they never picked one"""
+        code = self._language_cache.get(user_id)
+        if code is None:
+            lang = await async_database.get_user_language(user_id)
+            code = self._language_codes.get(lang, self.NO_LANGUAGE)
+            self._language_cache.put(user_id, code)
+        return None if code == self.NO_LANGUAGE else self.languages[code]
+    
+    async def set_language(self, user_id: int, lang: str) -> None:
+        self._language_cache.pop(user_id)
+        await async_database.set_user_language(user_id, lang)
+        self._language_cache.put(user_id, self._language_codes.get(lang, self.NO_LANGUAGE))
@@ -7,6 +7,8 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from user_tests import load_user_tests
+
 
 class Base(DeclarativeBase):
     pass
@@ -55,11 +57,10 @@ def get_stats():
     # Load test data from json file
     tests_count = 0
     try:
-        with open('../user_tests.json', 'r', encoding='utf-8') as f:
-            tests_data = json.load(f)
-            # Count all tests across users
-            for user_id, tests in tests_data.items():
-                tests_count += len(tests)
+        tests_data = load_user_tests()
+        # Count all tests across users
+        for user_id, tests in tests_data.items():
+            tests_count += len(tests)
     except (FileNotFoundError, json.JSONDecodeError):
         # If file doesn't exist or is invalid, just use 0
         pass
@@ -95,37 +96,36 @@ def get_tests():
     tests_by_user = {}
     
     try:
-        with open('../user_tests.json', 'r', encoding='utf-8') as f:
-            tests_data = json.load(f)
+        tests_data = load_user_tests()
+        
+        for user_id, tests in tests_data.items():
+            # Convert user_id to integer
+            user_id_int = int(user_id)
+            
+            # Get user info
+            user = User.query.get(user_id_int)
+            if not user:
+                username = "Unknown User"
+                full_name = "Unknown"
+            else:
+                username = user.username or "No Username"
+                full_name = f"{user.first_name or ''} {user.last_name or ''}".strip() or "Unknown"
+            
+            # Count tests and questions
+            test_count = len(tests)
+            total_questions = sum(len(test.get('questions', [])) for test in tests)
             
-            for user_id, tests in tests_data.items():
-                # Convert user_id to integer
-                user_id_int = int(user_id)
-                
-                # Get user info
-                user = User.query.get(user_id_int)
-                if not user:
-                    username = "Unknown User"
-                    full_name = "Unknown"
-                else:
-                    username = user.username or "No Username"
-                    full_name = f"{user.first_name or ''} {user.last_name or ''}".strip() or "Unknown"
-                
-                # Count tests and questions
-                test_count = len(tests)
-                total_questions = sum(len(test.get('questions', [])) for test in tests)
-                
-                tests_by_user[user_id] = {
-                    'user_id': user_id_int,
-                    'username': username,
-                    'full_name': full_name,
-                    'test_count': test_count,
-                    'total_questions': total_questions,
-                    'tests': [{
-                        'name': test.get('name', 'Unnamed Test'),
-                        'questions_count': len(test.get('questions', [])),
-                    } for test in tests]
-                }
+            tests_by_user[user_id] = {
+                'user_id': user_id_int,
+                'username': username,
+                'full_name': full_name,
+                'test_count': test_count,
+                'total_questions': total_questions,
+                'tests': [{
+                    'name': test.get('name', 'Unnamed Test'),
+                    'questions_count': len(test.get('questions', [])),
+                } for test in tests]
+            }
     except (FileNotFoundError, json.JSONDecodeError):
         # If file doesn't exist or is invalid, return empty data
         pass
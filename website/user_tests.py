@@ -0,0 +1,71 @@
+import json
+import logging
+import os
+import sys
+
+# The bot's binary snapshot decoder lives next to the bot, one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+try:
+    from storage_format import decode_snapshot, is_binary
+except ImportError:
+    decode_snapshot = None
+    
+    def is_binary(data):
+        return data[:4] == b"MQTS"
+
+
+def load_user_tests(path='../user_tests.json'):
+    """
+    Load the bot's tests as {user_id: [test]}
+    The bot appends new and deleted tests to `<path>.journal` and only folds them
+    into the snapshot now and then, so the journal is replayed on top of it
+    Raises json.JSONDecodeError if the snapshot is damaged
+    """
+    tests_data = {}
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            raw = f.read()
+        if is_binary(raw):
+            # TEST_STORAGE_FORMAT=binary; tests refer to their questions by hash
+            if decode_snapshot is not None:
+                tests_data = decode_snapshot(raw)["tests"]
+            else:
+                logging.warning(f"Can't read binary test snapshot {path} without storage_format.py")
+        else:
+            tests_data = json.loads(raw.decode('utf-8'))
+            # Version 2 files keep tests under "tests" and questions in a shared pool
+            if "version" in tests_data:
+                tests_data = tests_data["tests"]
+    
+    # A journal left by an unfinished compaction is older than the live one
+    for journal_path in (f"{path}.journal.old", f"{path}.journal"):
+        if not os.path.exists(journal_path):
+            continue
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The bot may be halfway through appending this record
+                    continue
+                apply_journal_record(tests_data, record)
+    return tests_data
+
+
+def apply_journal_record(tests_data, record):
+    """Apply one journal record the way the bot's TestStorage does"""
+    tests = tests_data.setdefault(record["user"], [])
+    if record["op"] == "put":
+        test = record["test"]
+        # A test with the same name is replaced in place
+        for i, existing in enumerate(tests):
+            if existing.get("name") == test["name"]:
+                tests[i] = test
+                break
+        else:
+            tests.append(test)
+    elif record["op"] == "delete":
+        if "id" in record:
+            tests[:] = [test for test in tests if test.get("id") != record["id"]]
+        else:
+            tests[:] = [test for test in tests if test.get("name") != record["name"]]